@@ -37,9 +37,16 @@ class Command(BaseCommand):
         known_files = [v['file_name'] for v in RawScanResult.objects.filter(
             file_name__isnull=False).values('file_name')]
 
+        # files of running scans are uploaded by the scan hosts before they
+        # are known to the db.
+        min_mtime = (timezone.now() - settings.SCAN_TOTAL_TIMEOUT).timestamp()
+
         deleted = 0
         for file in os.listdir(settings.RAW_DATA_DIR):
             if file not in known_files:
+                if os.path.getmtime(os.path.join(
+                        settings.RAW_DATA_DIR, file)) > min_mtime:
+                    continue
                 os.remove(os.path.join(
                     settings.RAW_DATA_DIR, file))
                 deleted += 1
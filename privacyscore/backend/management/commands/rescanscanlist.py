@@ -18,7 +18,7 @@ from time import sleep
 from django.core.management import BaseCommand
 from django.utils import timezone
 
-from privacyscore.backend.models import Site, ScanList
+from privacyscore.backend.models import Scan, Site, ScanList
 from privacyscore.utils import normalize_url
 
 
@@ -33,9 +33,16 @@ class Command(BaseCommand):
         scan_list = ScanList.objects.get(id=options['scan_list_id'])
         sites = scan_list.sites.all()
 
+        if options['sleep_between_scans']:
+            status_codes = (
+                (site, site.scan(Scan.LANE_LIST)) for site in sites)
+        else:
+            # schedule all scans at once
+            status = sites.scan()
+            status_codes = ((site, status[site.pk]) for site in sites)
+
         scan_count = 0
-        for site in sites:
-            status_code = site.scan()
+        for site, status_code in status_codes:
             if status_code == Site.SCAN_COOLDOWN:
                 self.stdout.write(
                     'Rate limiting -- Not scanning site {}'.format(site))
@@ -19,7 +19,7 @@ import sys
 from django.conf import settings
 from django.core.management import BaseCommand
 
-from privacyscore.backend.models import Site
+from privacyscore.backend.models import Scan, Site
 
 
 # increased max_tries from in schedulerescans from 5 to 50 because
@@ -53,7 +53,7 @@ class Command(BaseCommand):
             for i in range(min(MAX_TRIES, len(sites))):
                 site = sites.pop()
                 
-                status_code = site.scan()
+                status_code = site.scan(Scan.LANE_BACKGROUND)
                 if status_code == Site.SCAN_OK:
                     self.stdout.write('Scheduled scan of {}'.format(str(site)))
                     self.stdout.flush()
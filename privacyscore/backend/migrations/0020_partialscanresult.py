@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2026-10-17 09:12
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0019_blacklistentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PartialScanResult',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('test', models.CharField(max_length=80)),
+                ('result', django.contrib.postgres.fields.jsonb.JSONField(blank=True, null=True)),
+                ('scan', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='partial_results', to='backend.Scan')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='partialscanresult',
+            unique_together=set([('scan', 'test')]),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2026-10-17 14:21
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0020_partialscanresult'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduledTest',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('test', models.CharField(max_length=80)),
+                ('lane', models.CharField(blank=True, max_length=20, null=True)),
+                ('attempt', models.IntegerField(default=1)),
+                ('previous_results', django.contrib.postgres.fields.jsonb.JSONField(blank=True, null=True)),
+                ('created', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('not_before', models.DateTimeField(blank=True, null=True)),
+                ('dispatched', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('scan', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='scheduled_tests', to='backend.Scan')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='scheduledtest',
+            unique_together=set([('scan', 'test')]),
+        ),
+    ]
@@ -4,13 +4,14 @@ import random
 import string
 from collections import OrderedDict
 from datetime import datetime
-from tldextract import extract
-from typing import Iterable, Tuple, Union
-from uuid import uuid4
+from io import BytesIO
+from typing import Dict, Iterable, Set, Tuple, Union
 
+from celery import group
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.postgres import fields as postgres_fields
+from django.core.cache import cache
 from django.db import models, transaction
 from django.db.models import Count, Prefetch, QuerySet
 from django.db.models.expressions import RawSQL
@@ -18,6 +19,8 @@ from django.utils import timezone
 from django.utils.functional import cached_property
 
 from privacyscore.evaluation.site_evaluation import SiteEvaluation
+from privacyscore.scanner.raw_data import encode_raw_data_file
+from privacyscore.utils import extract_domain, pixelize_screenshot
 
 
 def generate_random_token() -> str:
@@ -154,14 +157,13 @@ class ScanList(models.Model):
                 tag_object = ListTag.objects.get_or_create(name=tag)[0]
                 tag_object.scan_lists.add(self)
 
-    def scan(self):
+    def scan(self, lane: str = None):
         """Schedule a scan of the list if requirements are fulfilled."""
+        if lane is None:
+            lane = Scan.LANE_LIST
+
+        res = Site.SCAN_OK in self.sites.all().scan(lane).values()
 
-        res = False
-        for site in self.sites.all():
-            if site.scan() == Site.SCAN_OK:
-                res = True
-        
         if self.editable:
             self.editable = False
             self.save(update_fields=('editable',))
@@ -230,6 +232,49 @@ class SiteQuerySet(models.QuerySet):
                 to_attr='ordered_column_values')
         )
 
+    def scan(self, lane: str = None) -> Dict[int, int]:
+        """
+        Schedule a scan of all sites if requirements are fulfilled.
+
+        The scans are scheduled in the specified lane, the list lane by
+        default.
+
+        The requirements of all sites are checked using a constant number of
+        queries, the scans are created using a single query and the tasks
+        are published as a single group.
+
+        Returns a dict mapping the pk of each site to a status code from the
+        list SCAN_OK, SCAN_COOLDOWN, SCAN_BLACKLISTED.
+        """
+        sites = list(self.annotate_most_recent_scan_start()
+                     .annotate_most_recent_scan_end_or_null()
+                     .select_related('last_scan'))
+        blacklisted_urls = BlacklistEntry.get_blacklisted_urls(
+            site.url for site in sites)
+
+        now = timezone.now()
+        status = {}
+        for site in sites:
+            if site.in_cooldown(now):
+                status[site.pk] = Site.SCAN_COOLDOWN
+            elif site.url in blacklisted_urls:
+                status[site.pk] = Site.SCAN_BLACKLISTED
+            else:
+                status[site.pk] = Site.SCAN_OK
+
+        scans = Scan.objects.bulk_create([
+            Scan(site=site) for site in sites
+            if status[site.pk] == Site.SCAN_OK])
+
+        if lane is None:
+            lane = Scan.LANE_LIST
+        from privacyscore.scanner.tasks import schedule_scan
+        if scans:
+            group(schedule_scan.s(scan.pk, lane)
+                  for scan in scans).apply_async()
+
+        return status
+
 
 class BlacklistEntry(models.Model):
     TYPE_DOMAIN = "DOM"
@@ -264,10 +309,34 @@ class BlacklistEntry(models.Model):
             'contact': self.contact,
         }
 
+    @staticmethod
+    def get_blacklisted_urls(urls: Iterable[str]) -> Set[str]:
+        """Get the subset of urls matched by any blacklist entry."""
+        domains = set()
+        subdomains = set()
+        for entry in BlacklistEntry.objects.all():
+            extract_entry = extract_domain(entry.url)
+            if entry.match_type == BlacklistEntry.TYPE_DOMAIN:
+                domains.add((extract_entry.domain, extract_entry.suffix))
+            elif entry.match_type == BlacklistEntry.TYPE_SUBDOMAIN:
+                subdomains.add((extract_entry.subdomain, extract_entry.domain,
+                                extract_entry.suffix))
+            else:
+                assert False, "Unknown BlacklistEntry match_type"
+
+        blacklisted = set()
+        for url in urls:
+            extract_url = extract_domain(url)
+            if ((extract_url.domain, extract_url.suffix) in domains or
+                    (extract_url.subdomain, extract_url.domain,
+                     extract_url.suffix) in subdomains):
+                blacklisted.add(url)
+        return blacklisted
+
     def match(self, target_url) -> bool:
         # Split into URL parts
-        extract_target = extract(target_url)
-        extract_self = extract(self.url)
+        extract_target = extract_domain(target_url)
+        extract_self = extract_domain(self.url)
 
         if self.match_type == BlacklistEntry.TYPE_DOMAIN:
             return (extract_target.domain == extract_self.domain and
@@ -314,26 +383,61 @@ class Site(models.Model):
                 v.value for v in self.column_values.order_by('column__sort_key')],
         }
 
-    def get_screenshot(self) -> Union[bytes, None]:
-        """Get the most recent screenshot of this site."""
-        screenshots = RawScanResult.objects.filter(
-            scan__site=self, identifier='cropped_screenshot').order_by(
-            'scan__end')
-        screenshot = screenshots.last()
-        if screenshot:
-            return screenshot.retrieve()
+    def _get_screenshots(self) -> QuerySet:
+        # Scans store the full screenshot only. Older scans stored a cropped
+        # and pixelized version as well.
+        return RawScanResult.objects.filter(
+            scan__site=self,
+            identifier__in=('screenshot', 'cropped_screenshot')).order_by(
+            'scan__end', 'pk')
+
+    def get_screenshot(self, image_format: str = 'png') -> Union[bytes, None]:
+        """
+        Get a cropped and pixelized version of the most recent screenshot
+        of this site.
+
+        The version is generated on the first request and cached afterwards.
+        The pixelized png stored by older scans is served as it is.
+        """
+        latest = self._get_screenshots().last()
+        if not latest:
+            return None
+        screenshots = {
+            screenshot.identifier: screenshot
+            for screenshot in self._get_screenshots().filter(
+                scan_id=latest.scan_id)
+        }
+        if image_format == 'png' and 'cropped_screenshot' in screenshots:
+            return screenshots['cropped_screenshot'].retrieve()
+        screenshot = screenshots.get('screenshot', latest)
+        cache_key = 'screenshot:{}:{}'.format(screenshot.pk, image_format)
+        rendition = cache.get(cache_key)
+        if rendition is None:
+            out = BytesIO()
+            pixelize_screenshot(
+                BytesIO(screenshot.retrieve()), out,
+                image_format=image_format)
+            rendition = out.getvalue()
+            cache.set(cache_key, rendition, getattr(
+                settings, 'SCREENSHOT_CACHE_TIMEOUT', 3600 * 24 * 14))
+        return rendition
 
     def has_screenshot(self) -> bool:
         """Check whether a screenshot for this site exists."""
-        return self.get_screenshot() is not None
+        return self._get_screenshots().exists()
 
-    def scan(self) -> int:
+    def scan(self, lane: str = None) -> int:
         """
         Schedule a scan of this site if requirements are fulfilled.
 
+        The scan is scheduled in the specified lane, the interactive lane by
+        default.
+
         Returns a status code from the list SCAN_OK, SCAN_COOLDOWN,
         SCAN_BLACKLISTED.
         """
+        if lane is None:
+            lane = Scan.LANE_INTERACTIVE
 
         scan_status = self.scannable()
         if scan_status != Site.SCAN_OK:
@@ -343,13 +447,21 @@ class Site(models.Model):
         scan = Scan.objects.create(site=self)
 
         from privacyscore.scanner.tasks import schedule_scan
-        schedule_scan.delay(scan.pk)
+        schedule_scan.delay(scan.pk, lane)
 
         return Site.SCAN_OK
 
     def scannable(self) -> int:
-        now = timezone.now()
+        if self.in_cooldown(timezone.now()):
+            return Site.SCAN_COOLDOWN
 
+        if BlacklistEntry.get_blacklisted_urls([self.url]):
+            return Site.SCAN_BLACKLISTED
+
+        return Site.SCAN_OK
+
+    def in_cooldown(self, now: datetime) -> bool:
+        """Check whether a scan is running or the last scan ended recently."""
         # fetch missing attributes
         if (not hasattr(self, 'last_scan__end_or_null') or
                 not hasattr(self, 'last_scan__start')):
@@ -357,16 +469,10 @@ class Site(models.Model):
             self.last_scan__end_or_null = last_scan.end if last_scan else None
             self.last_scan__start = last_scan.start if last_scan else None
 
-        if ((self.last_scan and 
-                now - self.last_scan.end < settings.SCAN_REQUIRED_TIME_BEFORE_NEXT_SCAN) or
-                (not self.last_scan__end_or_null and self.last_scan__start)):
-            return Site.SCAN_COOLDOWN
-
-        for entry in BlacklistEntry.objects.all():
-            if entry.match(self.url):
-                return Site.SCAN_BLACKLISTED
-
-        return Site.SCAN_OK
+        return bool(
+            (self.last_scan and self.last_scan.end and
+             now - self.last_scan.end < settings.SCAN_REQUIRED_TIME_BEFORE_NEXT_SCAN) or
+            (not self.last_scan__end_or_null and self.last_scan__start))
 
     def evaluate(self, group_order: list) -> SiteEvaluation:
         """Evaluate the result of the last scan."""
@@ -436,7 +542,17 @@ class Scan(models.Model):
       ScanError exists, the scan has (partially) **failed**
     * If start is set, end is set and no ScanResult exists, the scan has
       been **aborted**
+
+    Each scan is scheduled in a lane. The slaves are shared between the
+    lanes according to their weights (see SCAN_LANE_WEIGHTS).
     """
+    # A visitor is waiting for the scan of a single site
+    LANE_INTERACTIVE = 'interactive'
+    # Scan of a list
+    LANE_LIST = 'list'
+    # Periodic rescans
+    LANE_BACKGROUND = 'background'
+
     site = models.ForeignKey(
         Site, on_delete=models.CASCADE, related_name='scans')
 
@@ -478,41 +594,60 @@ class RawScanResult(models.Model):
         return self.file_name is None
 
     @staticmethod
-    def store_raw_data(data: bytes, mime_type: str, scan_host: str, test: str,
-                       identifier: str, scan_pk: int):
-        """Store data in db or filesystem."""
-        if len(data) > settings.RAW_DATA_DB_MAX_SIZE:
-            # store in filesystem
+    def store_raw_data(mime_type: str, scan_host: str, test: str,
+                       identifier: str, scan_pk: int, data: bytes = None,
+                       file_name: str = None):
+        """
+        Store data in db or filesystem.
+
+        If file_name is given, the data has already been written to the raw
+        data store by the scan host and only a reference is stored.
+        """
+        RawScanResult._prepare_raw_data(
+            mime_type, scan_host, test, identifier, scan_pk, data,
+            file_name).save()
 
-            # TODO: ensure uniqueness
-            file_name = str(uuid4())
+    @staticmethod
+    def store_raw_data_bulk(raw_data: Iterable[dict], scan_pk: int):
+        """
+        Store multiple raw data objects in db or filesystem. Each raw data
+        object is a dict of the keyword arguments of store_raw_data.
+
+        All files are written first, then the db entries are created using a
+        single query.
+        """
+        RawScanResult.objects.bulk_create([
+            RawScanResult._prepare_raw_data(scan_pk=scan_pk, **params)
+            for params in raw_data])
+
+    @staticmethod
+    def _prepare_raw_data(mime_type: str, scan_host: str, test: str,
+                          identifier: str, scan_pk: int, data: bytes = None,
+                          file_name: str = None) -> 'RawScanResult':
+        """Write data to the filesystem if required and return an unsaved
+        RawScanResult."""
+        if file_name is None and len(data) > settings.RAW_DATA_DB_MAX_SIZE:
+            # store in filesystem
+            file_name, content = encode_raw_data_file(data, mime_type)
             path = os.path.join(settings.RAW_DATA_DIR, file_name)
-            if mime_type in settings.RAW_DATA_UNCOMPRESSED_TYPES:
-                # do not compress
-                with open(path, 'wb') as f:
-                    f.write(data)
-            else:
-                file_name += '.gz'
-                path += '.gz'
-                # compress
-                with gzip.open(path, 'wb') as f:
-                    f.write(data)
+            with open(path, 'wb') as f:
+                f.write(content)
 
-            RawScanResult.objects.create(
+        if file_name is not None:
+            return RawScanResult(
                 scan_id=scan_pk,
                 scan_host=scan_host,
                 test=test,
                 identifier=identifier,
                 mime_type=mime_type,
                 file_name=file_name)
-        else:
-            RawScanResult.objects.create(
-                scan_id=scan_pk,
-                scan_host=scan_host,
-                test=test,
-                identifier=identifier,
-                mime_type=mime_type,
-                data=data)
+        return RawScanResult(
+            scan_id=scan_pk,
+            scan_host=scan_host,
+            test=test,
+            identifier=identifier,
+            mime_type=mime_type,
+            data=data)
 
     def retrieve(self) -> bytes:
         """Retrieve the raw data."""
@@ -545,6 +680,60 @@ class ScanResult(models.Model):
         return evaluate_result(self.result, group_order)
 
 
+class PartialScanResult(models.Model):
+    """
+    The processed result of a single test of a running scan.
+
+    Partial results are collected while the tests of a scan are running and
+    merged into the ScanResult once all tests have finished.
+    """
+    class Meta:
+        unique_together = (
+            ('scan', 'test'),
+        )
+
+    scan = models.ForeignKey(
+        Scan, on_delete=models.CASCADE, related_name='partial_results')
+    test = models.CharField(max_length=80)
+
+    result = postgres_fields.JSONField(null=True, blank=True)
+
+    def __str__(self) -> str:
+        return '{}: {}'.format(str(self.scan), self.test)
+
+
+class ScheduledTest(models.Model):
+    """
+    A single test of a running scan which is waiting to be dispatched to the
+    slaves or which is running.
+
+    The tests of all scans are dispatched by the master, so the number of
+    running tests is limited and the slaves are shared between the lanes.
+    """
+    class Meta:
+        unique_together = (
+            ('scan', 'test'),
+        )
+
+    scan = models.ForeignKey(
+        Scan, on_delete=models.CASCADE, related_name='scheduled_tests')
+    test = models.CharField(max_length=80)
+    lane = models.CharField(max_length=20, null=True, blank=True)
+    attempt = models.IntegerField(default=1)
+
+    # the previous results declared as inputs of the test
+    previous_results = postgres_fields.JSONField(null=True, blank=True)
+
+    created = models.DateTimeField(default=timezone.now, db_index=True)
+    # the test is not dispatched before this time
+    not_before = models.DateTimeField(null=True, blank=True)
+    # the time the test has been dispatched, null if it is waiting
+    dispatched = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    def __str__(self) -> str:
+        return '{}: {}'.format(str(self.scan), self.test)
+
+
 class ScanError(models.Model):
     """A single scan result key-value pair."""
     scan = models.ForeignKey(
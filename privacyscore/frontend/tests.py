@@ -1,3 +1,94 @@
-from django.test import TestCase
+from io import BytesIO
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from privacyscore.backend.models import RawScanResult, Scan, Site
+from privacyscore.frontend import views
+
+
+def _image(color: str, image_format: str = 'png') -> bytes:
+    out = BytesIO()
+    Image.new('RGB', (600, 800), color).save(out, format=image_format)
+    return out.getvalue()
+
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class SiteScreenshotTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.site = Site.objects.create(url='http://example.com/')
+        self.url = reverse('frontend:site_screenshot', args=(self.site.pk,))
+
+    def _store(self, identifier: str, data: bytes, end=None) -> Scan:
+        scan = Scan.objects.create(site=self.site, end=end or timezone.now())
+        self._add(scan, identifier, data)
+        return scan
+
+    @staticmethod
+    def _add(scan: Scan, identifier: str, data: bytes):
+        RawScanResult.objects.create(
+            scan=scan, scan_host='host', test='openwpm',
+            identifier=identifier, mime_type='image/png', data=data)
+
+    def test_missing(self):
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        self.assertFalse(self.site.has_screenshot())
+
+    def test_pixelized_on_request(self):
+        self._store('screenshot', _image('red'))
+        response = self.client.get(self.url, HTTP_ACCEPT='image/png')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertIn('Accept', response['Vary'])
+        image = Image.open(BytesIO(response.content))
+        self.assertEqual((image.format, image.width), ('PNG', 390))
+
+        # the pixelized version is cached
+        with mock.patch('privacyscore.backend.models.pixelize_screenshot') \
+                as pixelize:
+            self.assertEqual(
+                self.client.get(self.url).content, response.content)
+        pixelize.assert_not_called()
+
+    def test_webp(self):
+        self._store('screenshot', _image('red'))
+        with mock.patch.object(views, 'WEBP_SUPPORTED', True):
+            response = self.client.get(
+                self.url, HTTP_ACCEPT='image/webp,image/*')
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertIn('Accept', response['Vary'])
+        self.assertEqual(
+            Image.open(BytesIO(response.content)).format, 'WEBP')
+
+        # png and webp versions are cached separately
+        with mock.patch.object(views, 'WEBP_SUPPORTED', False):
+            response = self.client.get(self.url, HTTP_ACCEPT='image/webp')
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(Image.open(BytesIO(response.content)).format, 'PNG')
+
+    def test_most_recent_scan(self):
+        self._store('screenshot', _image('red'),
+                    timezone.now() - timezone.timedelta(days=1))
+        self._store('screenshot', _image('blue'))
+        image = Image.open(BytesIO(self.client.get(self.url).content))
+        self.assertEqual(image.convert('RGB').getpixel((0, 0)), (0, 0, 255))
+
+    def test_stored_pixelized_screenshot(self):
+        cropped = _image('green')
+        scan = self._store('screenshot', _image('red'))
+        self._add(scan, 'cropped_screenshot', cropped)
+        self.assertEqual(self.client.get(self.url).content, cropped)
+
+        # webp is generated from the full screenshot
+        with mock.patch.object(views, 'WEBP_SUPPORTED', True):
+            response = self.client.get(self.url, HTTP_ACCEPT='image/webp')
+        image = Image.open(BytesIO(response.content))
+        red, green, blue = image.convert('RGB').getpixel((0, 0))
+        self.assertGreater(red, 200)
+        self.assertLess(green + blue, 50)
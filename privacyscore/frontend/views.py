@@ -16,10 +16,12 @@ from django.db.models import Count, F, Prefetch, Q
 from django.http import HttpRequest, HttpResponse, HttpResponseNotFound, JsonResponse
 from django.shortcuts import get_object_or_404, redirect, render, reverse
 from django.template.response import TemplateResponse
+from django.utils.cache import patch_vary_headers
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
 from django.views.decorators.http import require_POST
 from django import forms
+from PIL import features
 from pygments import highlight
 from pygments.lexers import JsonLexer
 from pygments.formatters import HtmlFormatter
@@ -32,6 +34,10 @@ from privacyscore.frontend.forms import SingleSiteForm, CreateListForm
 from privacyscore.frontend.models import Spotlight
 from privacyscore.utils import normalize_url
 
+# Screenshots are served as webp to browsers supporting it if Pillow can
+# encode it.
+WEBP_SUPPORTED = features.check('webp')
+
 
 def index(request: HttpRequest) -> HttpResponse:
     scan_form = SingleSiteForm()
@@ -472,13 +478,21 @@ def _calculate_failures_count(sites):
 
 
 def site_screenshot(request: HttpRequest, site_id: int) -> HttpResponse:
-    """View a site and its most recent scan result (if any)."""
+    """View the pixelized screenshot of the most recent scan of a site."""
     site = get_object_or_404(Site, pk=site_id)
 
-    screenshot = site.get_screenshot()
+    image_format = 'png'
+    if (WEBP_SUPPORTED and
+            'image/webp' in request.META.get('HTTP_ACCEPT', '')):
+        image_format = 'webp'
+
+    screenshot = site.get_screenshot(image_format)
     if not screenshot:
         return HttpResponseNotFound(_('screenshot does not exist'))
-    return HttpResponse(screenshot, content_type='image/png')
+    response = HttpResponse(
+        screenshot, content_type='image/{}'.format(image_format))
+    patch_vary_headers(response, ('Accept',))
+    return response
 
 
 def view_site(request: HttpRequest, site_id: int) -> HttpResponse:
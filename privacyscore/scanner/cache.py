@@ -0,0 +1,138 @@
+"""
+A cache for expensive scan results which are shared by many sites, i.e. the
+results of scans of common mail servers.
+
+With a redis store, the cache is shared by all scan hosts. The in-memory store
+shares the cache within a single process only. Concurrent misses of the same
+key are computed only once: one worker computes the value while all others
+wait for it.
+"""
+import threading
+import time
+from typing import Callable, Union
+from uuid import uuid4
+
+import redis
+from django.conf import settings
+
+
+class InMemoryCacheStore:
+    """Cache entries and locks stored in the memory of the current process."""
+    def __init__(self):
+        self._entries = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Union[bytes, None]:
+        with self._lock:
+            value, expires = self._entries.get(key, (None, 0))
+            if expires < time.monotonic():
+                return None
+            return value
+
+    def set(self, key: str, value: bytes, ttl: int):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+
+    def acquire_lock(self, key: str, token: str, timeout: int) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            holder, expires = self._locks.get(key, (None, 0))
+            if holder is not None and expires >= now:
+                return False
+            self._locks[key] = (token, now + timeout)
+            return True
+
+    def release_lock(self, key: str, token: str):
+        with self._lock:
+            if self._locks.get(key, (None, 0))[0] == token:
+                del self._locks[key]
+
+
+class RedisCacheStore:
+    """Cache entries and locks stored in redis and shared by all scan hosts."""
+    RELEASE_SCRIPT = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(self, url: str, prefix: str = 'scancache:'):
+        self.prefix = prefix
+        self._redis = redis.StrictRedis.from_url(url)
+        self._release = self._redis.register_script(self.RELEASE_SCRIPT)
+
+    def get(self, key: str) -> Union[bytes, None]:
+        return self._redis.get(self.prefix + key)
+
+    def set(self, key: str, value: bytes, ttl: int):
+        self._redis.set(self.prefix + key, value, ex=ttl)
+
+    def acquire_lock(self, key: str, token: str, timeout: int) -> bool:
+        return bool(self._redis.set(
+            self.prefix + 'lock:' + key, token, nx=True, ex=timeout))
+
+    def release_lock(self, key: str, token: str):
+        self._release(keys=[self.prefix + 'lock:' + key], args=[token])
+
+
+class SharedCache:
+    """A cache computing the value of concurrently missed keys only once."""
+    def __init__(self, store: Union[InMemoryCacheStore, RedisCacheStore],
+                 poll_interval: float = 1):
+        self.store = store
+        self.poll_interval = poll_interval
+
+    def get_or_compute(self, key: str, compute: Callable[[], bytes],
+                       ttl: int, lock_timeout: int,
+                       cacheable: Callable[[bytes], bool] = None) -> bytes:
+        """
+        Get the value of key. If the key is missing, the value is computed
+        using compute and stored for ttl seconds. If cacheable is given, only
+        values for which it returns True are stored, so failures are not
+        served from the cache.
+
+        While the value is computed by one worker, all other workers wait for
+        it. If the computing worker does not finish within lock_timeout
+        seconds, another worker takes over.
+        """
+        value = self.store.get(key)
+        if value is not None:
+            return value
+
+        token = str(uuid4())
+        while True:
+            if self.store.acquire_lock(key, token, lock_timeout):
+                try:
+                    # the value may have been stored in the meantime
+                    value = self.store.get(key)
+                    if value is None:
+                        value = compute()
+                        if value and (cacheable is None or cacheable(value)):
+                            self.store.set(key, value, ttl)
+                    return value
+                finally:
+                    self.store.release_lock(key, token)
+
+            # another worker is computing the value
+            time.sleep(self.poll_interval)
+            value = self.store.get(key)
+            if value is not None:
+                return value
+
+
+_shared_cache = None
+
+
+def get_shared_cache() -> SharedCache:
+    """Get the shared cache of this process."""
+    global _shared_cache
+    if _shared_cache is None:
+        redis_url = getattr(settings, 'SCAN_CACHE_REDIS_URL', None)
+        if redis_url:
+            store = RedisCacheStore(redis_url)
+        else:
+            store = InMemoryCacheStore()
+        _shared_cache = SharedCache(store)
+    return _shared_cache
@@ -0,0 +1,114 @@
+"""
+Deadlines for requests to the scanned hosts.
+
+The timeout of a request applies to each connect and each read separately,
+so a server sending its response slowly can keep a request busy far longer.
+Sessions using a DeadlineAdapter register the connections of all requests
+with the deadline active in the current thread. When the deadline expires,
+the sockets of these connections are shut down, which interrupts all pending
+reads. Connecting is limited by the timeout of the request only.
+"""
+import socket
+import threading
+import time
+from functools import lru_cache
+
+from requests.adapters import HTTPAdapter
+
+
+_active = threading.local()
+
+
+class Deadline:
+    """
+    A deadline for the requests made by the current thread within a with
+    block. The deadline starts when it is created.
+    """
+    def __init__(self, seconds: float):
+        self.expires = time.monotonic() + seconds
+        self.expired = False
+
+        self._sockets = set()
+        self._lock = threading.Lock()
+        self._timer = threading.Timer(seconds, self.expire)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def __enter__(self) -> 'Deadline':
+        self._previous = getattr(_active, 'deadline', None)
+        _active.deadline = self
+        return self
+
+    def __exit__(self, type, value, traceback):
+        _active.deadline = self._previous
+        self._timer.cancel()
+        # the connections may be reused by other requests now
+        with self._lock:
+            self._sockets.clear()
+
+    def remaining(self) -> float:
+        """Get the number of seconds until the deadline expires."""
+        return self.expires - time.monotonic()
+
+    def expire(self):
+        """Expire the deadline now, aborting all pending reads."""
+        with self._lock:
+            self.expired = True
+            sockets = list(self._sockets)
+        for sock in sockets:
+            _shutdown(sock)
+
+    def register(self, sock: socket.socket):
+        """Shut down sock when the deadline expires."""
+        with self._lock:
+            if not self.expired:
+                self._sockets.add(sock)
+                return
+        _shutdown(sock)
+
+
+class DeadlineAdapter(HTTPAdapter):
+    """
+    A transport adapter registering the connections of each request with the
+    deadline active in the current thread.
+    """
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: _with_deadline(pool_class)
+            for scheme, pool_class in
+            self.poolmanager.pool_classes_by_scheme.items()}
+
+
+@lru_cache(maxsize=None)
+def _with_deadline(pool_class: type) -> type:
+    """Get a subclass of a connection pool class whose connections are
+    registered with the active deadline."""
+    class Connection(pool_class.ConnectionCls):
+        def connect(self):
+            super().connect()
+            _register(self.sock)
+
+        def request(self, *args, **kwargs):
+            # connections reused from the pool are connected already
+            _register(self.sock)
+            return super().request(*args, **kwargs)
+
+    return type(pool_class.__name__, (pool_class,), {
+        'ConnectionCls': Connection,
+    })
+
+
+def _register(sock: socket.socket):
+    deadline = getattr(_active, 'deadline', None)
+    if deadline is not None and sock is not None:
+        deadline.register(sock)
+
+
+def _shutdown(sock: socket.socket):
+    try:
+        # The socket of a tls connection is shut down directly, as its tls
+        # state may be in use by the reading thread.
+        socket.socket.shutdown(sock, socket.SHUT_RDWR)
+    except OSError:
+        pass
@@ -0,0 +1,19 @@
+"""
+Exceptions which can be raised by test suites.
+"""
+
+
+class RetryTest(Exception):
+    """
+    The test failed temporarily and should be run again later.
+
+    The test is rescheduled with a delay instead of blocking the worker.
+    Only tests declaring test_max_attempts may raise this exception.
+    """
+
+
+class RateLimitExceeded(RetryTest):
+    """
+    A request to a scanned host has not been allowed by the rate limits
+    within the maximum wait time.
+    """
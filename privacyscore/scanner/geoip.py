@@ -0,0 +1,86 @@
+"""
+Lookup of the countries of ip addresses, shared by all tasks of a worker
+process.
+
+The GeoIP database is opened once using mmap and reopened when the file on
+disk is replaced. The results of the most recent lookups are cached.
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Iterable, List, Union
+
+from django.conf import settings
+from geoip2.database import MODE_MMAP, Reader
+from geoip2.errors import AddressNotFoundError
+
+
+class GeoIPService:
+    """Lookup the countries of ip addresses in a GeoIP country database."""
+    def __init__(self, database_path: str, cache_size: int = 10000):
+        self.database_path = database_path
+        self.cache_size = cache_size
+
+        self._reader = None
+        self._database_stat = None
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def country(self, ip: str) -> Union[str, None]:
+        """Get the country (or continent) of ip, None if it is unknown."""
+        reader = self._get_reader()
+        with self._lock:
+            if ip in self._cache:
+                self._cache.move_to_end(ip)
+                return self._cache[ip]
+
+        try:
+            geoip_result = reader.country(ip)
+            result = geoip_result.country.name
+            if not result:
+                result = geoip_result.continent.name
+        except (AddressNotFoundError, ValueError):
+            result = None
+
+        with self._lock:
+            # do not cache results of a replaced database
+            if reader is self._reader:
+                self._cache[ip] = result
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return result
+
+    def countries(self, ips: Iterable[str]) -> List[str]:
+        """Get the distinct known countries of all ips."""
+        # TODO: Add entry specifying that at least one location has not been found
+        return list(set(
+            country for country in (self.country(ip) for ip in set(ips))
+            if country))
+
+    def _get_reader(self) -> Reader:
+        """Get the reader of the current database, reopening it if the file
+        has been replaced."""
+        stat = os.stat(self.database_path)
+        database_stat = (stat.st_ino, stat.st_mtime, stat.st_size)
+        with self._lock:
+            if self._reader is None or database_stat != self._database_stat:
+                # readers in use by other threads stay valid until they are
+                # garbage collected.
+                self._reader = Reader(self.database_path, mode=MODE_MMAP)
+                self._database_stat = database_stat
+                self._cache.clear()
+            return self._reader
+
+
+_services = {}
+_services_lock = threading.Lock()
+
+
+def get_geoip_service(database_path: str) -> GeoIPService:
+    """Get the GeoIP service of this process for database_path."""
+    with _services_lock:
+        if database_path not in _services:
+            _services[database_path] = GeoIPService(
+                database_path,
+                getattr(settings, 'SCAN_GEOIP_CACHE_SIZE', 10000))
+        return _services[database_path]
@@ -0,0 +1,75 @@
+import random
+import time
+
+from django.core.management import BaseCommand
+
+from privacyscore.test_suites.network import MINIMUM_SIMILARITY, \
+    _exact_jaccard_index, _jaccard_index
+
+
+class Command(BaseCommand):
+    help = 'Compare the content similarity of the network test, which ' \
+           'is calculated over the first SIMILARITY_MAX_INPUT_SIZE bytes ' \
+           'of each page, with the jaccard index of the complete pages.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='*',
+                            help='Pairs of files to compare. Random pages '
+                                 'are generated if no files are given.')
+        parser.add_argument('-n', '--num-pages', type=int, default=50)
+        parser.add_argument('-t', '--num-tokens', type=int, default=200000)
+
+    def handle(self, *args, **options):
+        if options['files']:
+            if len(options['files']) % 2:
+                raise ValueError('files have to be given in pairs')
+            pairs = []
+            for i in range(0, len(options['files']), 2):
+                with open(options['files'][i], 'rb') as f:
+                    a = f.read()
+                with open(options['files'][i + 1], 'rb') as f:
+                    b = f.read()
+                pairs.append((a, b))
+        else:
+            pairs = [self._random_pair(options['num_tokens'])
+                     for _ in range(options['num_pages'])]
+
+        complete_time = 0
+        capped_time = 0
+        max_difference = 0
+        mismatches = 0
+        for a, b in pairs:
+            start = time.perf_counter()
+            complete = _exact_jaccard_index(a, b)
+            complete_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            capped = _jaccard_index(a, b)
+            capped_time += time.perf_counter() - start
+
+            max_difference = max(max_difference, abs(complete - capped))
+            if ((complete > MINIMUM_SIMILARITY) !=
+                    (capped > MINIMUM_SIMILARITY)):
+                mismatches += 1
+
+        self.stdout.write('compared {} pairs'.format(len(pairs)))
+        self.stdout.write('complete: {:.3f}s, capped: {:.3f}s'.format(
+            complete_time, capped_time))
+        self.stdout.write(
+            'max difference: {:.4f}, different decisions: {}'.format(
+                max_difference, mismatches))
+
+    @staticmethod
+    def _random_pair(num_tokens: int):
+        """Generate two pages sharing a random fraction of their tokens."""
+        shared = random.uniform(0.7, 1)
+        a = []
+        b = []
+        for i in range(num_tokens):
+            token = 'token{}'.format(random.getrandbits(40))
+            a.append(token)
+            if random.random() < shared:
+                b.append(token)
+            else:
+                b.append('other{}'.format(random.getrandbits(40)))
+        return ' '.join(a).encode(), '\n'.join(b).encode()
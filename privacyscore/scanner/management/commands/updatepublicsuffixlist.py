@@ -0,0 +1,43 @@
+import os
+import re
+
+import requests
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+
+
+PUBLIC_SUFFIX_LIST_URL = 'https://publicsuffix.org/list/public_suffix_list.dat'
+
+
+class Command(BaseCommand):
+    help = 'Updates the public suffix list stored at PUBLIC_SUFFIX_LIST_PATH.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default=PUBLIC_SUFFIX_LIST_URL)
+        parser.add_argument(
+            '--path', default=getattr(settings, 'PUBLIC_SUFFIX_LIST_PATH', None))
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not path:
+            raise CommandError('PUBLIC_SUFFIX_LIST_PATH is not set')
+        try:
+            response = requests.get(options['url'], timeout=60)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            raise CommandError('Could not fetch the public suffix list: {}'.format(e))
+        content = response.content
+        if b'// ===BEGIN ICANN DOMAINS===' not in content:
+            raise CommandError('The response is not a public suffix list')
+
+        # replace the list atomically, so running workers never read a
+        # partial list
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(content)
+        os.rename(temp_path, path)
+
+        version = re.search(rb'^// VERSION: (\S+)', content, re.MULTILINE)
+        self.stdout.write('Updated the public suffix list to version {}'.format(
+            version.group(1).decode() if version else 'unknown'))
@@ -0,0 +1,191 @@
+"""
+Rate limiting of the requests of the test suites to the scanned hosts.
+
+The requests to each registered domain and each ip address are limited
+using a token bucket. With a redis store, the buckets are shared by all scan
+hosts, so the limit holds for the whole cluster. The in-memory store shares
+the buckets within a single process only.
+
+A request waits at most SCAN_RATE_LIMIT_MAX_WAIT seconds for its tokens.
+Otherwise RateLimitExceeded is raised, so tests supporting multiple attempts
+are rescheduled instead of blocking a worker until the suite timeout.
+"""
+import threading
+import time
+from typing import Iterable, Union
+
+import redis
+from django.conf import settings
+
+from privacyscore.scanner.exceptions import RateLimitExceeded
+from privacyscore.utils import get_registered_domain
+
+
+class InMemoryTokenBucketStore:
+    """Token buckets stored in the memory of the current process."""
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: float, burst: int) -> float:
+        """
+        Take a token from the bucket key.
+
+        Returns 0 if a token has been taken, the number of seconds until the
+        next token is available otherwise.
+        """
+        with self._lock:
+            now = time.monotonic()
+            tokens, timestamp = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - timestamp) * rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            return wait
+
+    def refund(self, key: str, burst: int):
+        """Put a token taken from the bucket key back."""
+        with self._lock:
+            if key in self._buckets:
+                tokens, timestamp = self._buckets[key]
+                self._buckets[key] = (min(burst, tokens + 1), timestamp)
+
+
+class RedisTokenBucketStore:
+    """Token buckets stored in redis and shared by all scan hosts."""
+    # The time of the redis server is used, so the clocks of the scan hosts
+    # do not need to be in sync.
+    TAKE_SCRIPT = """
+    if redis.replicate_commands then
+        redis.replicate_commands()
+    end
+    local rate = tonumber(ARGV[1])
+    local burst = tonumber(ARGV[2])
+    local time = redis.call('TIME')
+    local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'timestamp')
+    local tokens = tonumber(state[1]) or burst
+    local timestamp = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - timestamp) * rate)
+    local wait = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        wait = (1 - tokens) / rate
+    end
+    redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens),
+               'timestamp', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+    return tostring(wait)
+    """
+    REFUND_SCRIPT = """
+    local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens'))
+    if tokens then
+        local burst = tonumber(ARGV[1])
+        redis.call('HSET', KEYS[1], 'tokens',
+                   tostring(math.min(burst, tokens + 1)))
+    end
+    """
+
+    def __init__(self, url: str, prefix: str = 'ratelimit:'):
+        self.prefix = prefix
+        self._redis = redis.StrictRedis.from_url(url)
+        self._take = self._redis.register_script(self.TAKE_SCRIPT)
+        self._refund = self._redis.register_script(self.REFUND_SCRIPT)
+
+    def take(self, key: str, rate: float, burst: int) -> float:
+        """
+        Take a token from the bucket key.
+
+        Returns 0 if a token has been taken, the number of seconds until the
+        next token is available otherwise.
+        """
+        return float(self._take(keys=[self.prefix + key], args=[rate, burst]))
+
+    def refund(self, key: str, burst: int):
+        """Put a token taken from the bucket key back."""
+        self._refund(keys=[self.prefix + key], args=[burst])
+
+
+class RateLimiter:
+    """Limit the rate of requests per registered domain and ip address."""
+    def __init__(self, store: Union[InMemoryTokenBucketStore,
+                                    RedisTokenBucketStore],
+                 rate: float, burst: int, max_wait: float = 60):
+        self.store = store
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+
+    def acquire(self, key: str, deadline: float):
+        """
+        Wait until a token of the bucket key has been taken.
+
+        RateLimitExceeded is raised if no token can be taken before deadline
+        (in terms of time.monotonic).
+        """
+        while True:
+            wait = self.store.take(key, self.rate, self.burst)
+            if not wait:
+                return
+            if time.monotonic() + wait > deadline:
+                raise RateLimitExceeded(
+                    'Rate limit of {} exceeded'.format(key))
+            time.sleep(wait)
+
+    def throttle(self, hostname: str, addresses: Iterable[str] = ()):
+        """
+        Wait until a request to hostname is allowed by the limits of its
+        registered domain and all of its addresses.
+
+        RateLimitExceeded is raised if this takes longer than max_wait
+        seconds. The tokens taken until then are put back.
+        """
+        deadline = time.monotonic() + self.max_wait
+        domain = get_registered_domain(hostname) or hostname
+        keys = ['domain:{}'.format(domain)] + [
+            'ip:{}'.format(address) for address in addresses]
+        taken = []
+        try:
+            for key in keys:
+                self.acquire(key, deadline)
+                taken.append(key)
+        except RateLimitExceeded:
+            for key in taken:
+                self.store.refund(key, self.burst)
+            raise
+
+
+_rate_limiter = None
+
+
+def get_rate_limiter() -> Union[RateLimiter, None]:
+    """Get the rate limiter of this process, None if not configured."""
+    global _rate_limiter
+    rate = getattr(settings, 'SCAN_RATE_LIMIT_RATE', None)
+    if not rate:
+        return None
+    if _rate_limiter is None:
+        redis_url = getattr(settings, 'SCAN_RATE_LIMIT_REDIS_URL', None)
+        if redis_url:
+            store = RedisTokenBucketStore(redis_url)
+        else:
+            store = InMemoryTokenBucketStore()
+        _rate_limiter = RateLimiter(
+            store, rate, settings.SCAN_RATE_LIMIT_BURST,
+            getattr(settings, 'SCAN_RATE_LIMIT_MAX_WAIT', 60))
+    return _rate_limiter
+
+
+def throttle(hostname: str, addresses: Iterable[str] = ()):
+    """
+    Wait until a request to hostname is allowed by the configured rate
+    limits. This should be called by test suites before each request to a
+    scanned host.
+    """
+    rate_limiter = get_rate_limiter()
+    if rate_limiter is not None:
+        rate_limiter.throttle(hostname, addresses)
@@ -0,0 +1,104 @@
+"""
+Storage of raw data objects outside of the celery result backend.
+
+Raw data objects larger than RAW_DATA_DB_MAX_SIZE are stored as files in
+RAW_DATA_DIR on the master. If RAW_DATA_UPLOAD_URL is configured, slaves
+write these files to the raw data store directly and only send a reference
+to the file through the result backend.
+
+The upload url is either a file:// url of a directory which is shared with
+the master (i.e. RAW_DATA_DIR mounted on the slaves) or the http(s) url of a
+web server accepting PUT requests which stores the files in RAW_DATA_DIR
+(i.e. a WebDAV location).
+"""
+import gzip
+import os
+from typing import Dict, Tuple, Union
+from urllib.parse import urljoin, urlparse
+from uuid import uuid4
+
+import requests
+from django.conf import settings
+
+
+class FileSystemRawDataStore:
+    """Store raw data files in a local directory."""
+    def __init__(self, base_dir: str):
+        self.base_dir = base_dir
+
+    def write(self, file_name: str, content: bytes):
+        path = os.path.join(self.base_dir, file_name)
+        # write to a temporary file first, so the master never reads
+        # partially written files.
+        tmp_path = '{}.tmp'.format(path)
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.rename(tmp_path, path)
+
+
+class HTTPRawDataStore:
+    """Store raw data files on a web server using PUT requests."""
+    def __init__(self, base_url: str, timeout: int = 60):
+        if not base_url.endswith('/'):
+            base_url += '/'
+        self.base_url = base_url
+        self.timeout = timeout
+
+    def write(self, file_name: str, content: bytes):
+        response = requests.put(
+            urljoin(self.base_url, file_name), data=content,
+            timeout=self.timeout)
+        response.raise_for_status()
+
+
+def get_raw_data_store() -> Union[
+        FileSystemRawDataStore, HTTPRawDataStore, None]:
+    """Get the raw data store configured for uploads from the slaves."""
+    url = getattr(settings, 'RAW_DATA_UPLOAD_URL', None)
+    if not url:
+        return None
+    parsed = urlparse(url)
+    if parsed.scheme == 'file':
+        return FileSystemRawDataStore(parsed.path)
+    if parsed.scheme in ('http', 'https'):
+        return HTTPRawDataStore(url)
+    raise ValueError('Unsupported raw data upload url: {}'.format(url))
+
+
+def encode_raw_data_file(data: bytes, mime_type: str) -> Tuple[str, bytes]:
+    """
+    Generate a unique file name and the file content for a raw data object.
+    The data is compressed unless its mime type is listed in
+    RAW_DATA_UNCOMPRESSED_TYPES.
+    """
+    file_name = str(uuid4())
+    if mime_type in settings.RAW_DATA_UNCOMPRESSED_TYPES:
+        return file_name, data
+    return file_name + '.gz', gzip.compress(data)
+
+
+def upload_raw_data(raw_data: Dict[str, Dict[str, Union[str, bytes]]]) -> \
+        Dict[str, Dict[str, Union[str, bytes]]]:
+    """
+    Upload large raw data objects to the raw data store. The data of uploaded
+    objects is replaced by the file_name referencing the stored file.
+
+    If no raw data store is configured, the raw data is returned unchanged.
+    """
+    store = get_raw_data_store()
+    if store is None:
+        return raw_data
+
+    result = {}
+    for identifier, raw_elem in raw_data.items():
+        data = raw_elem.get('data')
+        if data is None or len(data) <= settings.RAW_DATA_DB_MAX_SIZE:
+            result[identifier] = raw_elem
+            continue
+        file_name, content = encode_raw_data_file(data, raw_elem['mime_type'])
+        store.write(file_name, content)
+        result[identifier] = {
+            'mime_type': raw_elem['mime_type'],
+            'file_name': file_name,
+        }
+    return result
@@ -0,0 +1,132 @@
+"""
+A caching DNS resolver shared by all tasks of a worker process.
+
+Answers are cached for the ttl of their records. Names which do not exist or
+have no records of the requested type are cached for SCAN_DNS_NEGATIVE_TTL
+seconds. Other failures like timeouts are not cached.
+
+If SCAN_DNS_SHARED_CACHE is set, answers are additionally stored in the cache
+shared by all scan hosts (see privacyscore.scanner.cache).
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Union
+
+from dns import resolver
+from django.conf import settings
+
+from privacyscore.scanner.cache import InMemoryCacheStore, RedisCacheStore, \
+    get_shared_cache
+
+
+class CachingResolver:
+    """A resolver caching the text representation of answers."""
+    def __init__(self, dns_resolver: resolver.Resolver = None,
+                 max_size: int = 10000, negative_ttl: int = 300,
+                 shared_store: Union[InMemoryCacheStore, RedisCacheStore,
+                                     None] = None):
+        if dns_resolver is None:
+            dns_resolver = resolver.get_default_resolver()
+        self.resolver = dns_resolver
+        self.max_size = max_size
+        self.negative_ttl = negative_ttl
+        self.shared_store = shared_store
+
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def query(self, name: str, rdtype: str) -> List[str]:
+        """
+        Get the text representation of all records of type rdtype of name.
+
+        Returns an empty list if name does not exist or has no such records.
+        dns.exception.DNSException is raised on other failures.
+        """
+        key = '{}:{}'.format(rdtype, name.lower())
+
+        records = self._get(key)
+        if records is not None:
+            return records
+
+        if self.shared_store is not None:
+            value = self.shared_store.get('dns:' + key)
+            if value is not None:
+                records, expires = json.loads(value.decode())
+                ttl = expires - time.time()
+                if ttl > 0:
+                    with self._lock:
+                        self.shared_hits += 1
+                    self._set(key, records, ttl)
+                    return records
+
+        with self._lock:
+            self.misses += 1
+        try:
+            answer = self.resolver.query(name, rdtype)
+            records = [rdata.to_text() for rdata in answer]
+            ttl = answer.rrset.ttl
+        except (resolver.NXDOMAIN, resolver.NoAnswer):
+            records = []
+            ttl = self.negative_ttl
+
+        self._set(key, records, ttl)
+        if self.shared_store is not None and ttl > 0:
+            self.shared_store.set(
+                'dns:' + key,
+                json.dumps([records, time.time() + ttl]).encode(), ttl)
+        return records
+
+    def stats(self) -> dict:
+        """Get the hit and miss counters of this resolver."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'size': len(self._cache),
+            }
+
+    def _get(self, key: str) -> Union[List[str], None]:
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            records, expires = entry
+            if expires < time.monotonic():
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return list(records)
+
+    def _set(self, key: str, records: List[str], ttl: float):
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._cache[key] = (list(records), time.monotonic() + ttl)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+
+_resolver = None
+
+
+def get_resolver() -> CachingResolver:
+    """Get the caching resolver of this process."""
+    global _resolver
+    if _resolver is None:
+        shared_store = None
+        if getattr(settings, 'SCAN_DNS_SHARED_CACHE', False):
+            shared_store = get_shared_cache().store
+        _resolver = CachingResolver(
+            max_size=getattr(settings, 'SCAN_DNS_CACHE_SIZE', 10000),
+            negative_ttl=getattr(settings, 'SCAN_DNS_NEGATIVE_TTL', 300),
+            shared_store=shared_store)
+    return _resolver
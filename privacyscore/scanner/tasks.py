@@ -1,36 +1,45 @@
-import os
-from getpass import getuser
 import signal
 import traceback
-from typing import List, Tuple
+from collections import Counter
+from datetime import timedelta
+from typing import Dict, List, Tuple, Union
 from socket import getfqdn
 
-from celery import chord, shared_task
+from celery import shared_task
 from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, Q
 from django.utils import timezone
 
-from privacyscore.backend.models import RawScanResult, Scan, ScanResult, \
-    ScanError
+from privacyscore.backend.models import PartialScanResult, RawScanResult, \
+    Scan, ScanResult, ScanError, ScheduledTest
+from privacyscore.scanner.exceptions import RetryTest
+from privacyscore.scanner.raw_data import upload_raw_data
 from privacyscore.scanner.test_suites import AVAILABLE_TEST_SUITES, \
-    TEST_PARAMETERS, SCAN_TEST_SUITE_STAGES
-from privacyscore.utils import get_processes_of_user
+    TEST_DEPENDENCIES, TEST_DEPENDENTS, TEST_INPUTS, TEST_MAX_ATTEMPTS, \
+    TEST_PARAMETERS, SCAN_TEST_SUITE_ORDER
+from privacyscore.utils import kill_child_processes
+
+
+# The key of the postgres advisory lock held while dispatching tests.
+DISPATCH_LOCK_ID = 4711
 
 
 class Timeout:
+    """
+    Abort the current task after the specified number of seconds.
+
+    Only processes started by the current task are killed, so multiple tasks
+    may run concurrently on the same host. Persistent processes reused by
+    multiple tasks, i.e. the pooled browsers of the openwpm suite, are kept.
+    """
     def __init__(self, seconds=1):
         self.seconds = seconds
 
     def __enter__(self):
         def handle_timeout(signum, frame):
-            # kill all possible processes
-            # TODO: this is a really bad idea
-            # TODO: Especially with multiple worker threads, bad things are inevitable
-            own_procs = get_processes_of_user(getuser())
-            for pid, cmdline in own_procs:
-                # TODO: Argh
-                if '/tests/' not in cmdline:
-                    continue
-                os.kill(pid, 9)
+            # kill all processes started by this task
+            kill_child_processes()
             raise TimeoutError
 
         signal.signal(signal.SIGALRM, handle_timeout)
@@ -40,83 +49,251 @@ class Timeout:
         signal.alarm(0)
 
 
+def get_retry_countdown(attempt: int) -> int:
+    """Get the delay in seconds before the attempt following attempt."""
+    return getattr(settings, 'SCAN_RETRY_DELAY', 10) * 2 ** (attempt - 1)
+
+
 @shared_task(queue='master')
-def schedule_scan(scan_pk: int):
+def schedule_scan(scan_pk: int, lane: str = None):
     """Prepare and schedule a scan."""
     scan = Scan.objects.get(pk=scan_pk)
     scan.start = timezone.now()
     scan.save()
 
-    # Schedule next stage
-    schedule_scan_stage(
-        (getfqdn(), 'privacyscore.scanner.tasks.schedule_scan', [], {}),
-        {},
-        scan_pk)
+    if not TEST_DEPENDENCIES:
+        _finish_scan(scan, {})
+        return
+
+    # Schedule all tests without dependencies
+    for test_suite in SCAN_TEST_SUITE_ORDER:
+        if not TEST_DEPENDENCIES[test_suite]:
+            _schedule_test(scan, test_suite, {}, lane)
+    dispatch_tests()
 
 
 @shared_task(queue='master')
-def schedule_scan_stage(new_results: Tuple[list, dict, dict],
-                        previous_results: Tuple[list, dict, dict],
-                        scan_pk: int,
-                        stage: int = 0,
-                        previous_task_count: int = 0):
-    """Schedule the next stage for a scan."""
-    scan = Scan.objects.get(pk=scan_pk)
+def handle_test_result(new_result: Union[tuple, dict, str], scan_pk: int,
+                       test_suite: str, lane: str = None, attempt: int = 1):
+    """
+    Store the result of a single test of a scan and schedule all tests whose
+    dependencies are fulfilled.
+
+    If the test asked to be retried, it is scheduled again after a delay.
+    """
+    handled = _handle_test_result(
+        new_result, scan_pk, test_suite, lane, attempt)
+    # The slot of the test is free now.
+    dispatch_tests()
+    return handled
+
+
+def _handle_test_result(new_result: Union[tuple, dict, str], scan_pk: int,
+                        test_suite: str, lane: str, attempt: int) -> bool:
+    with transaction.atomic():
+        # Lock the scan, so concurrently finishing tests of the same scan
+        # are handled one after another.
+        try:
+            scan = Scan.objects.select_for_update().select_related(
+                'site').get(pk=scan_pk)
+        except Scan.DoesNotExist:
+            # scan has been aborted in the meantime.
+            return False
+
+        if isinstance(new_result, dict) and 'retry' in new_result:
+            partial_results = dict(
+                scan.partial_results.values_list('test', 'result'))
+            _schedule_test(
+                scan, test_suite, _merge_results(partial_results), lane,
+                attempt + 1, get_retry_countdown(attempt))
+            return True
+
+        ScheduledTest.objects.filter(scan=scan, test=test_suite).delete()
+
+        raw_data, new_result, errors = _parse_new_results([new_result])
 
-    if previous_task_count <= 1:
-        new_results = [new_results]
-    raw_data, new_results, errors = _parse_new_results(new_results)
-    previous_results.update(new_results)
+        # store raw data in database
+        RawScanResult.store_raw_data_bulk(raw_data, scan_pk)
 
-    # store raw data in database
-    for params in raw_data:
-        RawScanResult.store_raw_data(scan_pk=scan_pk, **params)
+        # store errors in database
+        scan_errors = []
+        for error in errors:
+            scan_host = ''
+            test = None
+            if ':' in error:
+                scan_host, test, error = error.split(':', maxsplit=2)
+            scan_errors.append(ScanError(
+                scan_host=scan_host, scan=scan, test=test, error=error))
+        ScanError.objects.bulk_create(scan_errors)
 
-    # store errors in database
-    for error in errors:
-        test = None
-        if ':' in error:
-            scan_host, test, error = error.split(':', maxsplit=2)
-        ScanError.objects.create(
-            scan_host=scan_host, scan=scan, test=test, error=error)
+        PartialScanResult.objects.create(
+            scan=scan, test=test_suite, result=new_result)
+        partial_results = dict(
+            scan.partial_results.values_list('test', 'result'))
+        previous_results = _merge_results(partial_results)
 
-    if stage >= len(SCAN_TEST_SUITE_STAGES):
-        # all stages finished.
-        handle_finished_scan(scan)
+        if set(TEST_DEPENDENCIES) <= set(partial_results):
+            # all tests finished.
+            _finish_scan(scan, previous_results)
+            return True
+
+        # The tests depending on this test become ready when this was their
+        # last unfinished dependency. As the scan is locked, this is
+        # detected exactly once for each test.
+        for dependent in TEST_DEPENDENTS.get(test_suite, ()):
+            if TEST_DEPENDENCIES[dependent] <= set(partial_results):
+                _schedule_test(scan, dependent, previous_results, lane)
+
+    return True
+
+
+def _schedule_test(scan: Scan, test_suite: str, previous_results: dict,
+                   lane: str, attempt: int = 1, countdown: int = None):
+    """
+    Schedule a single test. The test is dispatched to the slaves by
+    dispatch_tests, but not before countdown seconds have passed.
+    """
+    not_before = None
+    if countdown:
+        not_before = timezone.now() + timedelta(seconds=countdown)
+        transaction.on_commit(
+            lambda: dispatch_tests.apply_async(countdown=countdown))
+    ScheduledTest.objects.update_or_create(
+        scan=scan, test=test_suite, defaults={
+            'lane': lane,
+            'attempt': attempt,
+            'previous_results': _project_results(
+                test_suite, previous_results),
+            'not_before': not_before,
+            'dispatched': None,
+        })
+
+
+@shared_task(queue='master')
+def dispatch_tests():
+    """
+    Dispatch scheduled tests to the slaves while less than
+    SCAN_DISPATCH_SLOTS tests are running.
+
+    If tests of multiple lanes are waiting, each free slot is given to the
+    lane with the least running tests relative to its weight (see
+    SCAN_LANE_WEIGHTS), so the slaves are shared between the lanes in
+    proportion to their weights. Within a lane, tests are dispatched in the
+    order they have been scheduled.
+    """
+    weights = getattr(settings, 'SCAN_LANE_WEIGHTS', {})
+    now = timezone.now()
+    # A test is aborted by the slave after the suite timeout. Tests without
+    # a result long after that have been lost and no longer occupy a slot.
+    lost = now - timedelta(seconds=2 * settings.SCAN_SUITE_TIMEOUT_SECONDS)
+
+    with transaction.atomic():
+        # Only one master worker dispatches tests at a time.
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT pg_advisory_xact_lock(%s)', [DISPATCH_LOCK_ID])
+
+        running = Counter(dict(
+            ScheduledTest.objects.filter(dispatched__gte=lost)
+            .values_list('lane').annotate(Count('pk'))))
+        free = getattr(settings, 'SCAN_DISPATCH_SLOTS', 16) - sum(
+            running.values())
+        if free <= 0:
+            return
+
+        waiting_tests = ScheduledTest.objects.filter(
+            Q(not_before__isnull=True) | Q(not_before__lte=now),
+            dispatched__isnull=True)
+        waiting = {}
+        for lane in waiting_tests.values_list('lane', flat=True).distinct():
+            waiting[lane] = list(
+                waiting_tests.filter(lane=lane).select_related('scan__site')
+                .order_by('created', 'pk')[:free])
+
+        def share(lane: str) -> tuple:
+            weight = weights.get(lane, 1)
+            return running[lane] / weight, -weight
+
+        dispatched = []
+        while free > 0 and any(waiting.values()):
+            lane = min((lane for lane in waiting if waiting[lane]), key=share)
+            dispatched.append(waiting[lane].pop(0))
+            running[lane] += 1
+            free -= 1
+
+        ScheduledTest.objects.filter(
+            pk__in=[test.pk for test in dispatched]).update(dispatched=now)
+        for test in dispatched:
+            transaction.on_commit(_get_test_publisher(test))
+
+
+def _get_test_publisher(test: ScheduledTest):
+    """Get a function publishing the task of a dispatched test."""
+    task = run_test.s(
+        test.test, test.scan.site.url, test.previous_results, test.attempt)
+    callback = handle_test_result.s(
+        test.scan_id, test.test, test.lane, test.attempt)
+    return lambda: task.apply_async(link=callback)
+
+
+def _project_results(test_suite: str, previous_results: dict) -> dict:
+    """Get the previous results declared as inputs of a test."""
+    inputs = TEST_INPUTS[test_suite]
+    if inputs is None:
+        return previous_results
+    return {
+        key: value for key, value in previous_results.items()
+        if key in inputs}
+
+
+def _merge_results(partial_results: Dict[str, dict]) -> dict:
+    """Merge the results of multiple tests in dependency order."""
+    result = {}
+    for test_suite in SCAN_TEST_SUITE_ORDER:
+        if partial_results.get(test_suite):
+            result.update(partial_results[test_suite])
+    return result
 
-        # store final results
-        ScanResult.objects.create(
-            scan=scan, result=previous_results)
 
-        return True
+def _finish_scan(scan: Scan, result: dict):
+    """Store the final result of a scan."""
+    handle_finished_scan(scan)
 
-    tasks = []
-    for test_suite in SCAN_TEST_SUITE_STAGES[stage]:
-        tasks.append(run_test.s(test_suite, scan.site.url, previous_results))
-    chord(tasks, schedule_scan_stage.s(previous_results, scan_pk, stage + 1, len(tasks))).apply_async()
+    # store final results
+    ScanResult.objects.create(scan=scan, result=result)
+    scan.partial_results.all().delete()
 
 
 def handle_finished_scan(scan: Scan):
     """
-    Callback when all stages of tasks for a scan are completed.
+    Callback when all tasks for a scan are completed.
     """
     scan.end = timezone.now()
     scan.save()
 
 
 @shared_task(queue='slave')
-def run_test(test_suite: str, url: str, previous_results: dict) -> bool:
+def run_test(test_suite: str, url: str, previous_results: dict,
+             attempt: int = 1) -> Union[tuple, dict, str]:
     """Run a single test against a single url."""
     test_parameters = TEST_PARAMETERS[test_suite]
+    max_attempts = TEST_MAX_ATTEMPTS[test_suite]
+    site_parameters = test_parameters
+    if max_attempts > 1:
+        site_parameters = dict(test_parameters, attempt=attempt)
     test_suite = AVAILABLE_TEST_SUITES[test_suite]
     try:
         with Timeout(settings.SCAN_SUITE_TIMEOUT_SECONDS):
             raw_data = test_suite.test_site(
-                url, previous_results, **test_parameters)
+                url, previous_results, **site_parameters)
             processed = test_suite.process_test_data(
                 raw_data, previous_results, **test_parameters)
-            return getfqdn(), test_suite.test_name, raw_data, processed
+            return (getfqdn(), test_suite.test_name,
+                    upload_raw_data(raw_data), processed)
     except Exception as e:
+        if isinstance(e, RetryTest) and attempt < max_attempts:
+            # The worker is released; the test is rescheduled by the master.
+            return {'retry': str(e)}
         return ':'.join([getfqdn(), test_suite.test_name, traceback.format_exc()])
 
 
@@ -130,6 +307,8 @@ def handle_aborted_scans():
     Scan.objects.filter(
         start__lt=now - settings.SCAN_TOTAL_TIMEOUT,
         end__isnull=True).delete()
+    # The tests of the aborted scans have been deleted, which may free slots.
+    dispatch_tests()
 
 
 def _parse_new_results(previous_results: List[Tuple[list, dict]]) -> tuple:
@@ -2,14 +2,15 @@
 This module loads all test suites from the test_suites directory
 and makes them accessible by their name.
 
-In addition, it generates the stages in which to run tests.
+In addition, it generates the dependency graph which determines the order
+in which tests are run.
 """
 import os
 from importlib import import_module
 from sys import stderr
 
 from django.conf import settings
-from toposort import toposort
+from toposort import toposort_flatten
 
 
 # Collect parameters for tests
@@ -43,12 +44,36 @@ for base_module in settings.TEST_SUITES_BASEMODULES:
         AVAILABLE_TEST_SUITES[test_module.test_name] = test_module
 
 
-# Generate stages based on dependencies.
+# Generate the dependency graph. Dependencies on tests which are not
+# configured can never be fulfilled and are ignored.
 TEST_DEPENDENCIES = {}
 for test in (t[0] for t in settings.SCAN_TEST_SUITES):
     if test not in AVAILABLE_TEST_SUITES:
         continue
     TEST_DEPENDENCIES[test] = set(AVAILABLE_TEST_SUITES[test].test_dependencies)
+for test, dependencies in TEST_DEPENDENCIES.items():
+    dependencies.intersection_update(TEST_DEPENDENCIES.keys())
 
+# The keys of the previous results read by each test. None if a test does
+# not declare its inputs and thus gets all previous results.
+TEST_INPUTS = {}
+for test in TEST_DEPENDENCIES:
+    inputs = getattr(AVAILABLE_TEST_SUITES[test], 'test_inputs', None)
+    TEST_INPUTS[test] = set(inputs) if inputs is not None else None
 
-SCAN_TEST_SUITE_STAGES = list(toposort(TEST_DEPENDENCIES))
+# The number of times each test may be run for a scan. Tests which may be
+# run more than once get the number of the current attempt.
+TEST_MAX_ATTEMPTS = {}
+for test in TEST_DEPENDENCIES:
+    TEST_MAX_ATTEMPTS[test] = getattr(
+        AVAILABLE_TEST_SUITES[test], 'test_max_attempts', 1)
+
+# The tests depending directly on each test.
+TEST_DEPENDENTS = {test: set() for test in TEST_DEPENDENCIES}
+for test, dependencies in TEST_DEPENDENCIES.items():
+    for dependency in dependencies:
+        TEST_DEPENDENTS[dependency].add(test)
+
+# A topological order of all tests. Results are merged in this order. This
+# raises an exception on circular dependencies.
+SCAN_TEST_SUITE_ORDER = toposort_flatten(TEST_DEPENDENCIES)
@@ -1,3 +1,694 @@
-from django.test import TestCase
+import json
+import sys
+import os
+import re
+import socket
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import requests
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from toposort import toposort_flatten
+
+from privacyscore.backend.models import PartialScanResult, Scan, \
+    ScanResult, ScheduledTest, Site
+from privacyscore.scanner import tasks
+from privacyscore.scanner.cache import InMemoryCacheStore, SharedCache
+from privacyscore.scanner.deadline import Deadline, DeadlineAdapter
+from privacyscore.scanner.exceptions import RateLimitExceeded
+from privacyscore.scanner.ratelimit import InMemoryTokenBucketStore, \
+    RateLimiter
+from privacyscore.test_suites import network, openwpm, serverleak, \
+    testssl_https
+from privacyscore.test_suites.testssl.common import load_testssl_result
+from privacyscore.utils import get_registered_domain, kill_child_processes, \
+    register_persistent_process, unregister_persistent_process
+
+
+class InMemoryTokenBucketStoreTestCase(TestCase):
+    def test_burst(self):
+        store = InMemoryTokenBucketStore()
+        for i in range(3):
+            self.assertEqual(store.take('foo', 1, 3), 0)
+        self.assertGreater(store.take('foo', 1, 3), 0)
+
+    def test_keys_are_independent(self):
+        store = InMemoryTokenBucketStore()
+        self.assertEqual(store.take('foo', 1, 1), 0)
+        self.assertGreater(store.take('foo', 1, 1), 0)
+        self.assertEqual(store.take('bar', 1, 1), 0)
+
+    def test_refill(self):
+        store = InMemoryTokenBucketStore()
+        self.assertEqual(store.take('foo', 1000, 1), 0)
+        wait = store.take('foo', 1000, 1)
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 0.001)
+
+
+class RateLimiterTestCase(TestCase):
+    def test_throttle(self):
+        limiter = RateLimiter(InMemoryTokenBucketStore(), 1000, 1)
+        limiter.throttle('www.example.com', ['127.0.0.1'])
+        limiter.throttle('example.com', ['127.0.0.1'])
+
+    def test_max_wait(self):
+        limiter = RateLimiter(InMemoryTokenBucketStore(), 1, 1, max_wait=0.1)
+        limiter.throttle('example.com')
+        start = time.monotonic()
+        with self.assertRaises(RateLimitExceeded):
+            limiter.throttle('www.example.com')
+        self.assertLess(time.monotonic() - start, 0.1)
+
+    def test_refund(self):
+        store = InMemoryTokenBucketStore()
+        limiter = RateLimiter(store, 0.001, 1, max_wait=0)
+        limiter.throttle('example.org', ['127.0.0.1'])
+        with self.assertRaises(RateLimitExceeded):
+            limiter.throttle('example.com', ['127.0.0.1'])
+        # the token of example.com has been put back
+        self.assertEqual(store.take('domain:example.com', 0.001, 1), 0)
+
+
+class ServerleakRateLimitTestCase(TestCase):
+    def test_rate_limit_exceeded(self):
+        with mock.patch.object(serverleak, 'throttle',
+                               side_effect=RateLimitExceeded('exceeded')):
+            self.assertEqual(
+                tasks.run_test('serverleak', 'http://example.com/',
+                               {'a_records': ['127.0.0.1']}, 1),
+                {'retry': 'exceeded'})
+
+
+class DeadlineTestCase(TestCase):
+    def test_expire(self):
+        # a server accepting connections without ever responding
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        self.addCleanup(server.close)
+
+        session = requests.Session()
+        session.mount('http://', DeadlineAdapter())
+        start = time.monotonic()
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            with Deadline(0.1) as deadline:
+                session.get('http://127.0.0.1:{}/'.format(
+                    server.getsockname()[1]), timeout=10)
+        self.assertTrue(deadline.expired)
+        self.assertLess(time.monotonic() - start, 5)
+
+
+class KillChildProcessesTestCase(TestCase):
+    def test_persistent_process(self):
+        task = subprocess.Popen(['sleep', '60'])
+        persistent = subprocess.Popen(['sleep', '60'])
+        self.addCleanup(persistent.wait)
+        self.addCleanup(persistent.kill)
+        register_persistent_process(persistent.pid)
+        self.addCleanup(unregister_persistent_process, persistent.pid)
+
+        kill_child_processes()
+        self.assertEqual(task.wait(5), -9)
+        self.assertIsNone(persistent.poll())
+
+
+class NetworkRateLimitTestCase(TestCase):
+    def setUp(self):
+        for lookup, records in (('_a_lookup', ['127.0.0.1']),
+                                ('_cname_lookup', []),
+                                ('_mx_lookup', []),
+                                ('_reverse_lookup', [])):
+            patcher = mock.patch.object(
+                network, lookup, return_value=records)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(
+            network, 'throttle', side_effect=RateLimitExceeded('exceeded'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_retry(self):
+        self.assertEqual(
+            tasks.run_test('network', 'http://example.com/', {}, 1),
+            {'retry': 'exceeded'})
+
+    def test_last_attempt(self):
+        result = network.test_site(
+            'http://example.com/', {}, None,
+            attempt=network.test_max_attempts)
+        general = json.loads(result['general']['data'].decode())
+        self.assertFalse(general['reachable'])
+        self.assertIn('RateLimitExceeded', general['unreachable_exception'])
+
+
+class PooledBrowserTestCase(TestCase):
+    def test_stop_orphan(self):
+        worker_id = 777
+        port = openwpm.CHROME_START_PORT + worker_id
+        temp_dir = tempfile.mkdtemp()
+        orphan = subprocess.Popen([
+            sys.executable, '-c', 'import time; time.sleep(60)',
+            '--remote-debugging-port={}'.format(port),
+            '--user-data-dir={}/chrome-profile'.format(temp_dir)])
+        self.addCleanup(orphan.wait)
+        self.addCleanup(orphan.kill)
+        pid_file = os.path.join(
+            tempfile.gettempdir(), 'privacyscore-chrome-{}.pid'.format(port))
+        with open(pid_file, 'w') as f:
+            f.write(str(orphan.pid))
+        self.addCleanup(os.remove, pid_file)
+        # wait until the arguments of the orphan are visible
+        time.sleep(0.1)
+
+        with mock.patch.object(openwpm.shutil, 'which', return_value=None):
+            with self.assertRaises(openwpm.ChromeBrowserStartupError):
+                openwpm._PooledBrowser(worker_id)
+        self.assertEqual(orphan.wait(5), -9)
+        self.assertFalse(os.path.exists(temp_dir))
+
+    def test_failed_dispose(self):
+        browser = mock.Mock(failed=False)
+        browser._target.Target.createBrowserContext.return_value = {
+            'browserContextId': 'C1'}
+        browser._target.Target.disposeBrowserContext.side_effect = \
+            openwpm.pychrome.TimeoutException
+        with openwpm._PooledBrowser.context(browser):
+            pass
+        self.assertTrue(browser.failed)
+        browser._target.Target.disposeBrowserContext.assert_called_once_with(
+            browserContextId='C1', _timeout=openwpm.CHROME_TIMEOUT)
+
+    def test_worker_process_shutdown(self):
+        with mock.patch.object(openwpm._browser_pool, 'discard') as discard:
+            openwpm.worker_process_shutdown.send(sender=None)
+        discard.assert_called_once_with()
+
+
+class OpenWPMResultTestCase(TestCase):
+    CRAWL_DATA = {
+        'site_url': 'https://www.example.com/',
+        'chrome_error': None,
+        'requests': [
+            {'url': 'https://www.example.com/', 'method': 'GET',
+             'headers': {'Accept': '*/*'}, 'is_thirdparty': False},
+            {'url': 'https://track.tracker.net/p.gif', 'method': 'GET',
+             'headers': {}, 'is_thirdparty': True},
+            {'url': 'https://ads.tracker.net/x.js', 'method': 'GET',
+             'headers': {}, 'is_thirdparty': True},
+            {'url': 'https://cdn.other.org/a.js', 'method': 'GET',
+             'headers': {}, 'is_thirdparty': True},
+        ],
+        'responses': [{'url': 'https://www.example.com/', 'status': 200}],
+        'third_parties': {
+            'fqdns': ['track.tracker.net', 'ads.tracker.net',
+                      'cdn.other.org'],
+            'num_http_requests': 1,
+            'num_https_requests': 2,
+        },
+        'tracking': {
+            'trackers': ['https://track.tracker.net/p.gif',
+                         'https://ads.tracker.net/x.js',
+                         'https://cdn.other.org/a.js'],
+        },
+        'google_analytics': {
+            'has_requests': True,
+            'anonymize': {'num_requests_aip': 1, 'num_requests_no_aip': 2},
+        },
+        'security_headers': {
+            'Content-Security-Policy': {'header_value': "default-src 'self'"},
+            'X-XSS-Protection': {'header_value': '1; mode=block'},
+            'X-Content-Type-Options': 'nosniff',
+            'Referrer-Policy': 'no-referrer',
+        },
+        'cookies': [
+            {'name': 'session', 'value': '1', 'domain': 'www.example.com',
+             'path': '/', 'expires': -1, 'secure': True, 'httpOnly': True,
+             'lifetime': 100, 'size': 8, 'sameSite': 'Lax'},
+            {'name': 'pref', 'value': '2', 'domain': '.example.com',
+             'path': '/', 'expires': 1900000000, 'secure': False,
+             'httpOnly': False, 'lifetime': 10 ** 6, 'size': 5},
+            {'name': 'uid', 'value': '3', 'domain': '.tracker.net',
+             'path': '/', 'expires': 1900000000, 'secure': True,
+             'httpOnly': False, 'lifetime': 10 ** 6, 'size': 4},
+            {'name': 'ad', 'value': '4', 'domain': 'ads.tracker.net',
+             'path': '/', 'expires': -1, 'secure': True,
+             'httpOnly': False, 'lifetime': 10, 'size': 3},
+            {'name': 'cdn', 'value': '5', 'domain': '.other.org',
+             'path': '/', 'expires': -1, 'secure': False,
+             'httpOnly': False, 'lifetime': 10, 'size': 4},
+            {'name': 'share', 'value': '6', 'domain': '.thirdparty.co.uk',
+             'path': '/', 'expires': 1900000000, 'secure': False,
+             'httpOnly': False, 'lifetime': 10 ** 6, 'size': 6},
+        ],
+        'insecure_content': {'has_mixed_content': False},
+        'tls': {'has_tls': True},
+        'javascript_logs': [{'message': 'x' * 100}],
+    }
+    PREVIOUS_RESULTS = {
+        'reachable': True,
+        'final_url': 'https://www.example.com/',
+        'final_url_is_https': True,
+    }
+
+    def _process(self, identifier: str, crawl_data: dict) -> dict:
+        raw_data = {identifier: {
+            'mime_type': 'application/json',
+            'data': json.dumps(crawl_data).encode(),
+        }}
+        return openwpm.process_test_data(
+            raw_data, self.PREVIOUS_RESULTS, '/tmp', '/tmp')
+
+    def test_summary(self):
+        summary = openwpm._summarize_crawl_data(self.CRAWL_DATA)
+        self.assertLess(len(json.dumps(summary)),
+                        len(json.dumps(self.CRAWL_DATA)))
+        result = self._process('crawlsummary', summary)
+        self.assertTrue(result['success'])
+        self.assertEqual(result, self._process('crawldata', self.CRAWL_DATA))
+
+    def test_failed_scan(self):
+        self.assertEqual(self._process('crawlsummary', None),
+                         self._process('crawldata', None))
+
+    def test_cookie_stats(self):
+        result = self._process('crawldata', self.CRAWL_DATA)
+        self.assertEqual(
+            [cookie['baseDomain'] for cookie in result['profilecookies']],
+            ['example.com', 'example.com', 'tracker.net', 'tracker.net',
+             'other.org', 'thirdparty.co.uk'])
+        # tracker.net is counted once as a tracking domain, but each of its
+        # cookies is counted
+        self.assertEqual(result['cookie_stats'], {
+            'first_party_short': 1,
+            'first_party_long': 1,
+            'first_party_flash': 0,
+            'third_party_short': 2,
+            'third_party_long': 2,
+            'third_party_flash': 0,
+            'third_party_track': 3,
+            'third_party_track_uniq': 2,
+            'third_party_track_domains': ['tracker.net', 'other.org'],
+        })
+
+    def test_cookie_stats_of_ip_address(self):
+        # hosts given by ip address have no registered domain, so all of
+        # them are first parties of a site given by ip address
+        cookies = [
+            {'baseDomain': get_registered_domain(domain), 'lifetime': lifetime}
+            for domain, lifetime in (
+                ('192.0.2.1', 10), ('192.0.2.7', 10 ** 6),
+                ('.tracker.net', 10), ('ads.tracker.net', 10 ** 6))]
+        self.assertEqual(openwpm.detect_cookies(
+            'http://192.0.2.1/', cookies, [],
+            self.CRAWL_DATA['tracking']['trackers']), {
+            'first_party_short': 1,
+            'first_party_long': 1,
+            'first_party_flash': 0,
+            'third_party_short': 1,
+            'third_party_long': 1,
+            'third_party_flash': 0,
+            'third_party_track': 2,
+            'third_party_track_uniq': 1,
+            'third_party_track_domains': ['tracker.net'],
+        })
+
+
+class SharedCacheTestCase(TestCase):
+    def test_get_or_compute(self):
+        cache = SharedCache(InMemoryCacheStore())
+        computed = []
+
+        def compute():
+            computed.append(True)
+            return b'foo'
+
+        self.assertEqual(cache.get_or_compute('key', compute, 60, 60), b'foo')
+        self.assertEqual(cache.get_or_compute('key', compute, 60, 60), b'foo')
+        self.assertEqual(len(computed), 1)
+
+    def test_uncacheable(self):
+        cache = SharedCache(InMemoryCacheStore())
+        computed = []
+
+        def compute():
+            computed.append(True)
+            return b'partial'
+
+        for _ in range(2):
+            self.assertEqual(cache.get_or_compute(
+                'key', compute, 60, 60, lambda value: value != b'partial'),
+                b'partial')
+        self.assertEqual(len(computed), 2)
+
+    def test_concurrent_misses(self):
+        cache = SharedCache(InMemoryCacheStore(), poll_interval=0.01)
+        computed = []
+
+        def compute():
+            computed.append(True)
+            time.sleep(0.1)
+            return b'foo'
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(
+                lambda _: cache.get_or_compute('key', compute, 60, 60),
+                range(4)))
+        self.assertEqual(results, [b'foo'] * 4)
+        self.assertEqual(len(computed), 1)
+
+
+class ScanSchedulingTestCase(TestCase):
+    # c depends on a, d on a and b, e on c and d
+    DEPENDENCIES = {
+        'a': set(),
+        'b': set(),
+        'c': {'a'},
+        'd': {'a', 'b'},
+        'e': {'c', 'd'},
+    }
+
+    def setUp(self):
+        dependents = {test: set() for test in self.DEPENDENCIES}
+        for test, dependencies in self.DEPENDENCIES.items():
+            for dependency in dependencies:
+                dependents[dependency].add(test)
+        patcher = mock.patch.multiple(
+            tasks,
+            TEST_DEPENDENCIES=self.DEPENDENCIES,
+            TEST_DEPENDENTS=dependents,
+            SCAN_TEST_SUITE_ORDER=toposort_flatten(self.DEPENDENCIES))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.scheduled = []
+        patcher = mock.patch.object(
+            tasks, '_schedule_test', side_effect=self._schedule_test)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        site = Site.objects.create(url='http://example.com/')
+        self.scan = Scan.objects.create(site=site)
+
+    def _schedule_test(self, scan, test_suite, previous_results, lane,
+                       attempt=1, countdown=None):
+        self.scheduled.append((test_suite, previous_results))
+
+    def _report(self, test_suite):
+        result = ('scanhost', test_suite, {}, {test_suite: True})
+        return tasks.handle_test_result(result, self.scan.pk, test_suite)
+
+    def test_dependencies(self):
+        tasks.schedule_scan(self.scan.pk)
+        self.assertEqual(
+            sorted(test for test, _ in self.scheduled), ['a', 'b'])
+
+        self.scheduled.clear()
+        self._report('b')
+        self.assertEqual(self.scheduled, [])
+        self._report('a')
+        self.assertEqual(sorted(test for test, _ in self.scheduled),
+                         ['c', 'd'])
+
+        self.scheduled.clear()
+        self._report('c')
+        self.assertEqual(self.scheduled, [])
+        self._report('d')
+        self.assertEqual(self.scheduled, [
+            ('e', {'a': True, 'b': True, 'c': True, 'd': True})])
+
+    def test_finish_scan(self):
+        with mock.patch.object(
+                tasks, '_finish_scan', wraps=tasks._finish_scan) as finish:
+            for test_suite in ('a', 'b', 'c', 'd'):
+                self._report(test_suite)
+                self.assertFalse(finish.called)
+            self._report('e')
+            self.assertEqual(finish.call_count, 1)
+
+        self.scan.refresh_from_db()
+        self.assertIsNotNone(self.scan.end)
+        self.assertEqual(ScanResult.objects.get(scan=self.scan).result, {
+            'a': True, 'b': True, 'c': True, 'd': True, 'e': True})
+        self.assertFalse(
+            PartialScanResult.objects.filter(scan=self.scan).exists())
+        # all tests have been scheduled exactly once
+        self.assertEqual(sorted(test for test, _ in self.scheduled),
+                         ['c', 'd', 'e'])
+
+    def test_aborted_scan(self):
+        self.scan.delete()
+        self.assertFalse(self._report('a'))
+        self.assertEqual(self.scheduled, [])
+
+
+@override_settings(SCAN_DISPATCH_SLOTS=8,
+                   SCAN_LANE_WEIGHTS={'interactive': 3, 'background': 1})
+class DispatchTestsTestCase(TestCase):
+    def setUp(self):
+        self.scans = [
+            Scan.objects.create(site=Site.objects.create(
+                url='http://{}.example.com/'.format(i)))
+            for i in range(20)]
+
+    def _schedule(self, lane, count, **kwargs):
+        for _ in range(count):
+            ScheduledTest.objects.create(
+                scan=self.scans.pop(), test='network', lane=lane, **kwargs)
+
+    def _dispatched(self, lane):
+        return ScheduledTest.objects.filter(
+            lane=lane, dispatched__isnull=False).count()
+
+    def test_weighted_sharing(self):
+        self._schedule('background', 10)
+        self._schedule('interactive', 10)
+        tasks.dispatch_tests()
+        self.assertEqual(self._dispatched('interactive'), 6)
+        self.assertEqual(self._dispatched('background'), 2)
+
+    def test_free_slots(self):
+        self._schedule('background', 6, dispatched=timezone.now())
+        self._schedule('interactive', 4)
+        tasks.dispatch_tests()
+        self.assertEqual(self._dispatched('interactive'), 2)
+
+        # tests of lost tasks no longer occupy a slot
+        ScheduledTest.objects.filter(lane='background').update(
+            dispatched=timezone.now() - timedelta(days=1))
+        tasks.dispatch_tests()
+        self.assertEqual(self._dispatched('interactive'), 4)
+
+    def test_single_lane(self):
+        self._schedule('background', 10)
+        tasks.dispatch_tests()
+        self.assertEqual(self._dispatched('background'), 8)
+
+    def test_not_before(self):
+        self._schedule(
+            'interactive', 1, not_before=timezone.now() + timedelta(hours=1))
+        tasks.dispatch_tests()
+        self.assertEqual(self._dispatched('interactive'), 0)
+
+
+class SimilarityTestCase(TestCase):
+    @staticmethod
+    def _page(tokens: range) -> bytes:
+        return b' '.join(b'token%d' % i for i in tokens)
+
+    def test_index(self):
+        a = self._page(range(0, 100))
+        b = self._page(range(50, 150))
+        self.assertAlmostEqual(network._jaccard_index(a, b), 50 / 150)
+        self.assertEqual(network._jaccard_index(a, a), 1)
+        self.assertEqual(network._jaccard_index(a, b'foo bar'), 0)
+
+    def test_capped_input(self):
+        a = self._page(range(0, 20000))
+        b = self._page(range(0, 10000)) + b' ' + \
+            self._page(range(30000, 40000))
+        size = len(self._page(range(0, 10000)))
+        with mock.patch.object(network, 'SIMILARITY_MAX_INPUT_SIZE', size):
+            self.assertEqual(network._jaccard_index(a, b), 1)
+        self.assertAlmostEqual(network._jaccard_index(a, b), 1 / 3)
+
+    def test_ignored_tokens(self):
+        a = b'foo bar /index.html'
+        b = b'foo\nbar /about.html'
+        self.assertEqual(network._jaccard_index(a, b), 1)
+
+
+class HSTSPreloadIndexTestCase(TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+        self._write([
+            {'name': 'example.com', 'include_subdomains': True},
+            {'name': 'example.org'},
+        ])
+
+    def _write(self, entries):
+        with open(self.path, 'w') as f:
+            json.dump({'entries': entries}, f)
+
+    def test_is_preloaded(self):
+        index = testssl_https._HSTSPreloadIndex(self.path)
+        self.assertTrue(index.is_preloaded('example.com'))
+        self.assertTrue(index.is_preloaded('www.example.com'))
+        self.assertTrue(index.is_preloaded('a.b.example.com'))
+        self.assertTrue(index.is_preloaded('example.org'))
+        self.assertFalse(index.is_preloaded('www.example.org'))
+        self.assertFalse(index.is_preloaded('com'))
+        self.assertFalse(index.is_preloaded('notexample.com'))
+
+    def test_reload(self):
+        index = testssl_https._HSTSPreloadIndex(self.path)
+        self.assertFalse(index.is_preloaded('example.net'))
+        self._write([{'name': 'example.net'}])
+        self.assertTrue(index.is_preloaded('example.net'))
+        self.assertFalse(index.is_preloaded('example.com'))
+
+
+class SignatureMatcherTestCase(TestCase):
+    TEXTS = [
+        '',
+        'ref: refs/heads/master',
+        '<title>phpinfo()</title>',
+        'Apache Server Status for example.com',
+        'Apache Server Information',
+        '-- MySQL dump\nCREATE TABLE foo;\nINSERT INTO foo VALUES (1);',
+        'DROP TABLE IF EXISTS `foo`;',
+        'SQLite format 3',
+        '\x7fELF\x02\x01',
+        'phpinfo( ref ELV Bud -----BEGI',
+    ]
+
+    def _naive_matches(self, pattern, text):
+        if isinstance(pattern, tuple):
+            return any(self._naive_matches(p, text) for p in pattern)
+        return pattern in text
+
+    def test_matches(self):
+        patterns = {pattern for _, pattern in serverleak.TRIALS}
+        matcher = serverleak._SignatureMatcher(patterns)
+        for text in self.TEXTS:
+            for pattern in patterns:
+                self.assertEqual(matcher.matches(pattern, text),
+                                 self._naive_matches(pattern, text),
+                                 (pattern, text))
+
+    def test_regex_and_callable(self):
+        pattern = (re.compile(r'v\d+'), lambda text: text.endswith('!'))
+        matcher = serverleak._SignatureMatcher([pattern, 'foo'])
+        self.assertTrue(matcher.matches(pattern, 'v1'))
+        self.assertTrue(matcher.matches(pattern, 'foo!'))
+        self.assertFalse(matcher.matches(pattern, 'foo'))
+        self.assertIsNone(matcher.overlap(pattern))
+        self.assertEqual(matcher.overlap(('foo', 'ab')), 2)
+
+    def test_read_content(self):
+        response = mock.Mock()
+        with Deadline(60) as deadline:
+            for text in self.TEXTS:
+                content = text.encode()
+                for chunk_size in (1, 2, 3, 5):
+                    response.iter_content.return_value = [
+                        content[i:i + chunk_size]
+                        for i in range(0, len(content), chunk_size)]
+                    for _, pattern in serverleak.TRIALS:
+                        read = []
+                        with mock.patch.object(
+                                serverleak, 'TRIAL_CHUNK_SIZE', chunk_size):
+                            serverleak._read_content(
+                                response, pattern, read, deadline)
+                        self.assertEqual(
+                            self._naive_matches(pattern, ''.join(read)),
+                            self._naive_matches(pattern, text),
+                            (pattern, text, chunk_size))
+
+
+class LoadTestsslResultTestCase(TestCase):
+    SCAN_RESULT = """
+          {
+               "targetHost"  : "example.com",
+               "port"        : "443",
+               "protocols"   : [
+                          {
+                               "id"           : "TLS1_2",
+                               "severity"     : "OK",
+                               "finding"      : "TLS 1.2 is offered"
+                          }
+                              ],
+               "cipherTests" : [
+                          {
+                               "id"           : "cipher_x9f",
+                               "finding"      : "ends ] with } brackets { [ and \\"quotes\\" \\\\"
+                          }
+                              ],
+               "browserSimulations": [
+                          {
+                               "id"           : "client_\\"[{",
+                               "finding"      : "{ \\" ]"
+                          }
+                              ],
+               "pfs"         : [
+                          {
+                               "id"           : "PFS",
+                               "severity"     : "OK",
+                               "finding"      : "offered"
+                          }
+                              ]
+          }"""
+
+    def _document(self, invocation: str, last: bool = False) -> bytes:
+        keys = [
+            '"at": "host:/usr/bin/openssl"',
+            '"version": "3.0 "',
+            '"scanResult": [{}]'.format(self.SCAN_RESULT),
+            '"scanTime": 12',
+        ]
+        if last:
+            keys.append(invocation)
+        else:
+            keys.insert(1, invocation)
+        return '{{\n{}\n}}\n'.format(',\n'.join(keys)).encode()
+
+    def _expected(self):
+        scan_result = json.loads(self.SCAN_RESULT)
+        del scan_result['cipherTests']
+        del scan_result['browserSimulations']
+        return {
+            'at': 'host:/usr/bin/openssl',
+            'version': '3.0 ',
+            'scanResult': [scan_result],
+            'scanTime': 12,
+        }
+
+    def test_skipped_sections(self):
+        expected = self._expected()
+        expected['Invocation'] = 'testssl.sh -p example.com'
+        self.assertEqual(load_testssl_result(self._document(
+            '"Invocation": "testssl.sh -p example.com"')), expected)
+
+    def test_unescaped_invocation(self):
+        invocation = '"Invocation": "testssl.sh --warnings "off" example.com"'
+        for last in (False, True):
+            with mock.patch.object(json, 'loads', wraps=json.loads) as loads:
+                result = load_testssl_result(
+                    self._document(invocation, last))
+            self.assertEqual(result, self._expected())
+            loads.assert_not_called()
+
+    def test_truncated(self):
+        document = self._document('"Invocation": "testssl.sh"')
+        for length in (len(document) // 3, len(document) - 4):
+            with mock.patch.object(json, 'loads', wraps=json.loads) as loads:
+                with self.assertRaises(ValueError):
+                    load_testssl_result(document[:length])
+            loads.assert_called_once()
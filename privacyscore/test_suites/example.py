@@ -10,6 +10,17 @@ A test must declare a test_dependencies list containing the test_name of all
 tests that need to be run before the test itself (and thus the results of that
 tests are provided within the previous_results dictionary).
 If a test does not have dependencies, an empty list should be supplied.
+
+A test may declare a test_inputs list containing the keys of the previous
+results it reads. Only those keys are sent to the test within the
+previous_results dictionary, which keeps the messages sent to the workers
+small. If test_inputs is not declared, all previous results are supplied.
+
+A test may declare test_max_attempts. If it is larger than one, the test
+function gets the number of the current attempt as keyword argument attempt
+and may raise privacyscore.scanner.exceptions.RetryTest on temporary
+failures. The test is then run again after a delay, unless it has been
+attempted test_max_attempts times already.
 """
 # Copyright (C) 2017 PrivacyScore Contributors
 # 
@@ -31,6 +42,7 @@ from typing import Dict, Union
 
 test_name = 'example'
 test_dependencies = ['another_example', 'foobar']
+test_inputs = ['final_url', 'reachable']
 
 
 def test_site(url: str, previous_results: dict, **options) -> Dict[str, Dict[str, Union[str, bytes]]]:
@@ -43,9 +55,11 @@ def test_site(url: str, previous_results: dict, **options) -> Dict[str, Dict[str
 
     It always gets the following positional arguments:
     * The url. This is the url of the site which should be tested.
-    * A dictionary containing the *processed* results of all tests from
-      previous test stages. If there have not been any tests yielding results
-      in a previous stage, the dictionary is empty.
+    * A dictionary containing the *processed* results of all tests which
+      have finished before this test has been scheduled. This always
+      includes the results of all tests listed in test_dependencies. If
+      there have not been any tests yielding results before, the dictionary
+      is empty.
 
     In addition, a test function can get arbitrary parameters. The values
     for those parameters can then be specified in the settings where the test
@@ -4,25 +4,32 @@ addresses and the final URL after following any HTTP forwards.
 """
 
 import json
+import logging
 import re
+import threading
 import traceback
-from typing import Dict, List, Union
-from urllib.parse import urlparse
-import subprocess
-import os
+from typing import Callable, Dict, List, Set, Tuple, Union
+from urllib.parse import urljoin, urlparse
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 
 import requests
-from dns import resolver, reversename
+import urllib3
+from dns import reversename
 from dns.exception import DNSException
-from geoip2.database import Reader
-from geoip2.errors import AddressNotFoundError
+
+from privacyscore.scanner.deadline import Deadline, DeadlineAdapter
+from privacyscore.scanner.exceptions import RateLimitExceeded
+from privacyscore.scanner.geoip import get_geoip_service
+from privacyscore.scanner.ratelimit import throttle
+from privacyscore.scanner.resolver import get_resolver
 
 
 test_name = 'network'
 test_dependencies = []
-
-# TODO put the path somewhere else, maybe in settings
-HSTS_FILE = "/opt/privacyscore/.wget-hsts"
+test_inputs = []
+# The test is rescheduled when the rate limits of the site are exceeded.
+test_max_attempts = 3
 
 # The minimum Jaccard coefficient required for the
 # comparison of http and https version of a site
@@ -31,59 +38,197 @@ HSTS_FILE = "/opt/privacyscore/.wget-hsts"
 # that the scanned site is not available via https)
 MINIMUM_SIMILARITY = 0.90
 
-def retrieve_url_with_wget(url):
-    """calls wget and extracts the final url and the http body from the response
-       IndexError or subprocess.CalledProcessError will be thrown if site is unreachable
+# The similarity is calculated over the first SIMILARITY_MAX_INPUT_SIZE bytes
+# of each page.
+SIMILARITY_MAX_INPUT_SIZE = 1024 * 1024
+
+# The maximum number of seconds spent for all DNS lookups of a site. Lookups
+# which have not finished in time are treated as failed.
+DNS_TIME_BUDGET = 30
+
+# The maximum number of concurrent DNS lookups of a site.
+DNS_MAX_CONCURRENT_LOOKUPS = 8
+
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64; rv:53.0) Gecko/20100101 Firefox/53.0'
+
+# The maximum number of seconds for retrieving a url including all redirects
+# and its content.
+FETCH_TIMEOUT = 15
+
+# The maximum number of redirects followed when retrieving a url.
+FETCH_MAX_REDIRECTS = 20
+
+# The maximum number of bytes of content retrieved from a url.
+FETCH_MAX_CONTENT_SIZE = 5 * 1024 * 1024
+
+# We do not verify certificates when retrieving urls.
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+def retrieve_url(url: str, deadline: Deadline = None,
+                 on_response: Callable[[requests.Response], None] = None) -> \
+        Tuple[str, bytes, str, List[str]]:
     """
-    
-    # TODO this is hacky, but necessary, because (only) on some of our scan hosts
-    # we have a wget version that implements hsts. Once all VMs are upgraded, we can
-    # use the --no-hsts parameter of wget
-    if os.path.isfile(HSTS_FILE):
-        os.remove(HSTS_FILE)
-    
-    # this needs python 3.5, but some of our VMs still have Python 3.4
-    #proc = subprocess.run(['wget', '--no-verbose', url, '-O-', '--no-check-certificate',
-    #                      '--user-agent="Mozilla/5.0 (X11; Linux x86_64; rv:53.0) Gecko/20100101 Firefox/53.0"'],
-    #                     stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-    cmd = ['env', 'LC_ALL=C', 'wget', '--no-verbose', url, '-O-', \
-           '--no-check-certificate',
-           '--user-agent="Mozilla/5.0 (X11; Linux x86_64; rv:53.0) Gecko/20100101 Firefox/53.0"']
-    proc = subprocess.Popen(cmd,
-                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    Retrieve url following all redirects.
+
+    Returns a tuple (final_url, content, http_error, redirects) where
+    redirects is the list of urls redirecting to the final url. If the server
+    responds with an error status, http_error describes the error and
+    final_url and content are None. Only the first FETCH_MAX_CONTENT_SIZE
+    bytes of the content are retrieved. If given, on_response is called with
+    the final response before its content is retrieved.
+
+    Retrieving the url including all redirects and the content is aborted
+    when deadline expires, FETCH_TIMEOUT seconds by default.
+
+    requests.exceptions.RequestException is raised if the site is
+    unreachable.
+    """
+    if deadline is None:
+        deadline = Deadline(FETCH_TIMEOUT)
+    session = _create_session()
     try:
-        (stdout, stderr) = proc.communicate(timeout=15)
-    except subprocess.TimeoutExpired:
-        proc.kill()
+        with deadline:
+            return _retrieve_url(session, url, deadline, on_response)
+    except Exception as e:
+        if deadline.expired:
+            raise requests.exceptions.Timeout(
+                'Retrieving {} took too long'.format(url)) from e
         raise
-    
-    # if wget returns 8, this indicates HTTP status != 200
-    http_error = None
-    final_url = None
-    content = None
-
-    if proc.returncode == 8:
-        if re.search('(ERROR .*)', stderr.decode(errors='replace')):
-            http_error = re.search('(ERROR .*)', stderr.decode(errors='replace')).group(1)
-        else:
-            http_error = "Unspecified error."
-
-    # we do error handling this way so that error handling in the caller is already compatible with subprocess.run
-    elif not proc.returncode == 0:
-        raise subprocess.CalledProcessError(proc.returncode, " ".join(cmd))
-    
-    else:
-        # wget output looks like this:
-        # '2017-12-21 10:34:51 URL:https://www.example.com/foo/bar [64407] -> "-" [1]\n'
-        if re.search('URL:([^ ]+)', stderr.decode(errors='replace')):
-            final_url = re.search('URL:([^ ]+)', stderr.decode(errors='replace')).group(1)
-        content = stdout
-    
-    return final_url, content, http_error
-    
+    finally:
+        session.close()
+
+
+def _retrieve_url(session: requests.Session, url: str, deadline: Deadline,
+                  on_response: Callable[[requests.Response], None]) -> \
+        Tuple[str, bytes, str, List[str]]:
+    # Redirects are followed here, so every request is limited by the time
+    # remaining until the deadline.
+    redirects = []
+    while True:
+        timeout = deadline.remaining()
+        if timeout <= 0:
+            raise requests.exceptions.Timeout(
+                'Retrieving {} took too long'.format(url))
+        response = session.get(
+            url, stream=True, allow_redirects=False, timeout=timeout)
+        target = session.get_redirect_target(response)
+        if target is None:
+            break
+        # consume the content, so the connection can be reused
+        response.content
+        response.close()
+        redirects.append(response.url)
+        if len(redirects) > FETCH_MAX_REDIRECTS:
+            raise requests.exceptions.TooManyRedirects(
+                'Exceeded {} redirects.'.format(FETCH_MAX_REDIRECTS))
+        url = urljoin(response.url, target)
+
+    with response:
+        if on_response is not None:
+            on_response(response)
+        if response.status_code >= 400:
+            http_error = 'ERROR {}: {}.'.format(
+                response.status_code, response.reason)
+            return None, None, http_error, redirects
+
+        content = []
+        size = 0
+        for chunk in response.iter_content(64 * 1024):
+            content.append(chunk)
+            size += len(chunk)
+            if size >= FETCH_MAX_CONTENT_SIZE:
+                break
+        if deadline.expired:
+            # the content has been cut off
+            raise requests.exceptions.Timeout(
+                'Retrieving {} took too long'.format(url))
+        content = b''.join(content)[:FETCH_MAX_CONTENT_SIZE]
+        return response.url, content, None, redirects
+
+
+def _create_session() -> requests.Session:
+    """
+    Create a session for retrieving a url. Its connections are reused for all
+    redirects to the same host.
+    """
+    session = requests.Session()
+    adapter = DeadlineAdapter()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    # like browsers, we follow sites with invalid certificates
+    session.verify = False
+    session.headers['User-Agent'] = USER_AGENT
+    return session
 
-def test_site(url: str, previous_results: dict, country_database_path: str) -> Dict[str, Dict[str, Union[str, bytes]]]:
-    """Test the specified url with geoip."""
+
+class _SiteRetrieval:
+    """
+    Retrieve the http version of a site and, unless it is redirected to
+    https, the https version concurrently.
+
+    The https version is retrieved as soon as the final response of the http
+    version turns out not to be https. Running retrievals are aborted when
+    the retrieval is closed, i.e. when the test times out.
+    """
+    def __init__(self, url: str, addresses: List[str]):
+        self.url = url
+        self.https_url = 'https:/' + url.split('/', maxsplit=1)[1]
+        self.addresses = addresses
+
+        self._executor = ThreadPoolExecutor(max_workers=2)
+        self._deadlines = []
+        self._closed = False
+        self._lock = threading.Lock()
+
+        self._https = None
+        self.http = self._submit(url, self._check_response)
+        if url.startswith('https'):
+            self._https = self.http
+
+    def https(self) -> Future:
+        """Get the retrieval of the https version, starting it if needed."""
+        with self._lock:
+            if self._https is None:
+                self._https = self._submit(self.https_url)
+            return self._https
+
+    def close(self):
+        """Abort all running retrievals."""
+        with self._lock:
+            self._closed = True
+            deadlines = list(self._deadlines)
+        for deadline in deadlines:
+            deadline.expire()
+        self._executor.shutdown(wait=False)
+
+    def _submit(self, url: str, on_response: Callable[
+            [requests.Response], None] = None) -> Future:
+        return self._executor.submit(self._retrieve, url, on_response)
+
+    def _retrieve(self, url: str, on_response: Callable[
+            [requests.Response], None]) -> Tuple[str, bytes, str, List[str]]:
+        throttle(urlparse(url).hostname, self.addresses)
+        with self._lock:
+            if self._closed:
+                raise requests.exceptions.Timeout(
+                    'Retrieving {} has been aborted'.format(url))
+            deadline = Deadline(FETCH_TIMEOUT)
+            self._deadlines.append(deadline)
+        return retrieve_url(url, deadline, on_response)
+
+    def _check_response(self, response: requests.Response):
+        if not response.url.startswith('https'):
+            self.https()
+
+
+def test_site(url: str, previous_results: dict, country_database_path: str,
+              attempt: int = 1) -> Dict[str, Dict[str, Union[str, bytes]]]:
+    """
+    Test the specified url with geoip.
+
+    If the rate limits of the site are exceeded, the test is retried. In the
+    last attempt, the site is reported as unreachable instead.
+    """
     result = {}
     general_result = {}
 
@@ -91,28 +236,56 @@ def test_site(url: str, previous_results: dict, country_database_path: str) -> D
     hostname = urlparse(url).hostname
 
     # DNS
-    # cname records
-    general_result['cname_records'] = _cname_lookup(hostname)
-
-    # a records
-    general_result['a_records'] = _a_lookup(hostname)
-
-    # mx records
-    general_result['mx_records'] = _mx_lookup(hostname)
-    if hostname.startswith('www.'):
-        general_result['mx_records'] += _mx_lookup(hostname[4:])
-
-    # mx a-records
-    general_result['mx_a_records'] = [(pref, _a_lookup(mx)) for pref, mx in general_result['mx_records']]
-
-    # reverse a
-    general_result['a_records_reverse'] = [_reverse_lookup(a) for a in general_result['a_records']]
-
-    # reverse mx-a
-    general_result['mx_a_records_reverse'] = [
-        (pref,
-         [_reverse_lookup(a) for a in mx_a])
-        for pref, mx_a in general_result['mx_a_records']]
+    # Independent lookups are run concurrently, each as soon as the records
+    # it depends on are known.
+    lookups = _ConcurrentLookups(DNS_TIME_BUDGET)
+    try:
+        # cname records
+        cname_records = lookups.submit(_cname_lookup, hostname)
+
+        # a records
+        a_records = lookups.submit(_a_lookup, hostname)
+
+        # mx records
+        mx_records = [lookups.submit(_mx_lookup, hostname)]
+        if hostname.startswith('www.'):
+            mx_records.append(lookups.submit(_mx_lookup, hostname[4:]))
+
+        general_result['a_records'] = lookups.result(a_records)
+
+        # reverse a
+        a_records_reverse = [
+            lookups.submit(_reverse_lookup, a)
+            for a in general_result['a_records']]
+
+        general_result['mx_records'] = [
+            mx for future in mx_records for mx in lookups.result(future)]
+
+        # mx a-records
+        mx_a_records = [
+            (pref, lookups.submit(_a_lookup, mx))
+            for pref, mx in general_result['mx_records']]
+        general_result['mx_a_records'] = [
+            (pref, lookups.result(future)) for pref, future in mx_a_records]
+
+        # reverse mx-a
+        mx_a_records_reverse = [
+            (pref,
+             [lookups.submit(_reverse_lookup, a) for a in mx_a])
+            for pref, mx_a in general_result['mx_a_records']]
+
+        general_result['cname_records'] = lookups.result(cname_records)
+        general_result['a_records_reverse'] = [
+            lookups.result(future) for future in a_records_reverse]
+        general_result['mx_a_records_reverse'] = [
+            (pref,
+             [lookups.result(future) for future in futures])
+            for pref, futures in mx_a_records_reverse]
+    finally:
+        lookups.shutdown()
+
+    logging.getLogger(__name__).debug(
+        'DNS cache statistics: %s', get_resolver().stats())
 
     general_result['reachable'] = True
     
@@ -121,51 +294,64 @@ def test_site(url: str, previous_results: dict, country_database_path: str) -> D
         general_result['reachable'] = False
 
     else:
-        # determine final url
+        retrieval = _SiteRetrieval(url, general_result['a_records'])
         try:
-            wget_final_url, wget_content, http_error = retrieve_url_with_wget(url)
-            if http_error:
-                general_result['http_error'] = http_error
-                general_result['final_url'] = url # so that we can check the https version below
-            else:
-                general_result['final_url'] = wget_final_url
-                result['final_url_content'] = {
-                    'mime_type': 'text/html', # probably not always correct, leaving that for later ...
-                    'data': wget_content,
-                }
-        
-        # if subprocess.run failed OR re.search did not find anything suitable: raise an exception!
-        except (IndexError, subprocess.CalledProcessError, subprocess.TimeoutExpired):
-            # TODO: extend api to support registration of partial errors
-            general_result['unreachable_exception'] = traceback.format_exc()
-            general_result['final_url'] = url
-            general_result['reachable'] = False
-            result['general'] = {
-                'mime_type': 'application/json',
-                'data': json.dumps(general_result).encode(),
-            }
-            return result
-
-        # now let's check the https version again (unless we already have been redirected there)
-        if not general_result['final_url'].startswith('https'):
-            https_url = 'https:/' + url.split('/', maxsplit=1)[1]
+            # determine final url
             try:
-                
-                wget_final_url, wget_content, https_error = retrieve_url_with_wget(https_url)
-                
-                if https_error:
-                    general_result['https_error'] = https_error
-                    general_result['final_https_url'] = https_url 
+                final_url, content, http_error, redirects = \
+                    retrieval.http.result()
+                general_result['redirects'] = redirects
+                if http_error:
+                    general_result['http_error'] = http_error
+                    general_result['final_url'] = url # so that we can check the https version below
                 else:
-                    general_result['final_https_url'] = wget_final_url
-                    result['final_https_url_content'] = {
+                    general_result['final_url'] = final_url
+                    result['final_url_content'] = {
                         'mime_type': 'text/html', # probably not always correct, leaving that for later ...
-                        'data': wget_content,
+                        'data': content,
                     }
-            except (IndexError, subprocess.CalledProcessError, subprocess.TimeoutExpired):
-                general_result['final_https_url'] = False
-        else:
-            general_result['final_https_url'] = general_result['final_url']
+
+            except (requests.exceptions.RequestException,
+                    RateLimitExceeded) as e:
+                if (isinstance(e, RateLimitExceeded) and
+                        attempt < test_max_attempts):
+                    raise
+                # TODO: extend api to support registration of partial errors
+                general_result['unreachable_exception'] = traceback.format_exc()
+                general_result['final_url'] = url
+                general_result['reachable'] = False
+                result['general'] = {
+                    'mime_type': 'application/json',
+                    'data': json.dumps(general_result).encode(),
+                }
+                return result
+
+            # now let's check the https version again (unless we already have been redirected there)
+            if not general_result['final_url'].startswith('https'):
+                try:
+                    final_url, content, https_error, redirects = \
+                        retrieval.https().result()
+                    general_result['https_redirects'] = redirects
+
+                    if https_error:
+                        general_result['https_error'] = https_error
+                        general_result['final_https_url'] = retrieval.https_url
+                    else:
+                        general_result['final_https_url'] = final_url
+                        result['final_https_url_content'] = {
+                            'mime_type': 'text/html', # probably not always correct, leaving that for later ...
+                            'data': content,
+                        }
+                except (requests.exceptions.RequestException,
+                        RateLimitExceeded) as e:
+                    if (isinstance(e, RateLimitExceeded) and
+                            attempt < test_max_attempts):
+                        raise
+                    general_result['final_https_url'] = False
+            else:
+                general_result['final_https_url'] = general_result['final_url']
+        finally:
+            retrieval.close()
 
 
     result['general'] = {
@@ -180,12 +366,12 @@ def process_test_data(raw_data: list, previous_results: dict, country_database_p
     result = json.loads(raw_data['general']['data'].decode())
 
     # geoip
-    reader = Reader(country_database_path)
+    geoip = get_geoip_service(country_database_path)
 
-    result['a_locations'] = _get_countries(result['a_records'], reader)
-    result['mx_locations'] = _get_countries(
-        (ip for mx_a_records in result['mx_a_records']
-         for ip in mx_a_records[1]), reader)
+    result['a_locations'] = geoip.countries(result['a_records'])
+    result['mx_locations'] = geoip.countries(
+        ip for mx_a_records in result['mx_a_records']
+        for ip in mx_a_records[1])
 
     # TODO: reverse mx-a matches mx
 
@@ -203,24 +389,60 @@ def process_test_data(raw_data: list, previous_results: dict, country_database_p
     return result
 
 
+class _ConcurrentLookups:
+    """
+    Run DNS lookups concurrently within a time budget. Identical lookups are
+    run only once.
+    """
+    def __init__(self, time_budget: float):
+        self._deadline = time.monotonic() + time_budget
+        self._executor = ThreadPoolExecutor(
+            max_workers=DNS_MAX_CONCURRENT_LOOKUPS)
+        self._futures = {}
+
+    def submit(self, lookup: Callable[[str], list], name: str) -> Future:
+        key = (lookup, name)
+        if key not in self._futures:
+            self._futures[key] = self._executor.submit(lookup, name)
+        return self._futures[key]
+
+    def result(self, future: Future) -> list:
+        """Get the result of a lookup, an empty list if it did not finish
+        within the time budget."""
+        done, _ = wait(
+            [future], timeout=max(0, self._deadline - time.monotonic()))
+        if not done:
+            return []
+        return future.result()
+
+    def shutdown(self):
+        # do not wait for lookups exceeding the time budget
+        for future in self._futures.values():
+            future.cancel()
+        self._executor.shutdown(wait=False)
+
+
 def _a_lookup(name: str) -> List[str]:
     try:
-        return [e.address for e in resolver.query(name, 'A')]
+        return get_resolver().query(name, 'A')
     except DNSException:
         return []
 
 
 def _cname_lookup(name: str) -> List[str]:
     try:
-        return [e.to_text()[:-1].lower() for e in resolver.query(name, 'CNAME')]
+        return [e[:-1].lower() for e in get_resolver().query(name, 'CNAME')]
     except DNSException:
         return []
 
 
 def _mx_lookup(name: str) -> List[str]:
     try:
-        return sorted([(e.preference, e.exchange.to_text()[:-1].lower())
-                       for e in resolver.query(name, 'MX')], key=lambda v: v[0])
+        records = []
+        for e in get_resolver().query(name, 'MX'):
+            preference, exchange = e.split()
+            records.append((int(preference), exchange[:-1].lower()))
+        return sorted(records, key=lambda v: v[0])
     except DNSException:
         return []
 
@@ -228,36 +450,38 @@ def _mx_lookup(name: str) -> List[str]:
 def _reverse_lookup(ip: str) -> List[str]:
     try:
         address = reversename.from_address(ip).to_text()
-        return [rev.to_text()[:-1].lower()
-                for rev in resolver.query(address, 'PTR')]
+        return [rev[:-1].lower()
+                for rev in get_resolver().query(address, 'PTR')]
     except DNSException:
         return []
 
 
-def _get_countries(addresses: List[str], reader: Reader) -> List[str]:
-    res = set()
-    for ip in addresses:
-        try:
-            geoip_result = reader.country(ip)
-            this_result = geoip_result.country.name
-            if not this_result:
-                this_result = geoip_result.continent.name
-            if not this_result:
-                raise AddressNotFoundError
-            res.add(this_result)
-        except AddressNotFoundError:
-            # TODO: Add entry specifying that at least one location has not been found
-            continue
-    return list(res)
+def _jaccard_index(a: bytes, b: bytes) -> float:
+    """
+    Calculate the jaccard similarity of the tokens of a and b.
 
+    Only the first SIMILARITY_MAX_INPUT_SIZE bytes of a and b are compared,
+    so memory and time are bounded.
+    """
+    return _exact_jaccard_index(
+        a[:SIMILARITY_MAX_INPUT_SIZE], b[:SIMILARITY_MAX_INPUT_SIZE])
 
-def _jaccard_index(a: bytes, b: bytes) -> float:
-    """Calculate the jaccard similarity of a and b."""
-    pattern = re.compile(rb' |\n')
-    # remove tokens containing / to prevent wrong classifications for
-    # absolute paths
-    a = set(token for token in pattern.split(a) if b'/' not in token)
-    b = set(token for token in pattern.split(b) if b'/' not in token)
+
+def _exact_jaccard_index(a: bytes, b: bytes) -> float:
+    """Calculate the exact jaccard similarity of a and b."""
+    a = _tokens(a)
+    b = _tokens(b)
     intersection = a.intersection(b)
     union = a.union(b)
     return len(intersection) / len(union)
+
+
+TOKEN_SEPARATOR = re.compile(rb' |\n')
+
+
+def _tokens(data: bytes) -> Set[bytes]:
+    """Get the space and newline separated tokens of data."""
+    # remove tokens containing / to prevent wrong classifications for
+    # absolute paths
+    return {token for token in set(TOKEN_SEPARATOR.split(data))
+            if b'/' not in token}
@@ -2,37 +2,301 @@
 Check the website for privacy issues like cookies, 3rd parties, etc, using OpenWPM.
 """
 
+import atexit
 import json
 import logging
 import os
 import shutil
+import signal
+import subprocess
+import tempfile
 import time
+from contextlib import contextmanager
 
-from io import BytesIO
-from typing import Dict, Union
+from pathlib import Path
+from typing import Dict, Iterator, Union
+from urllib.parse import urlparse
 from uuid import uuid4
 
-import tldextract
+import pychrome
+from celery.signals import worker_process_shutdown
+from requests.exceptions import ConnectionError
 
-from PIL import Image
-
-from privacyscanner.scanmodules.chromedevtools import scan_site
-from privacyscanner.scanmeta import ScanMeta
+from privacyscanner.scanmodules.chromedevtools import EXTRACTOR_CLASSES
+from privacyscanner.scanmodules.chromedevtools.chromescan import \
+    CHROME_OPTIONS, PREFS, ChromeBrowserStartupError, PageScanner
 from privacyscanner.result import Result
 from privacyscanner.filehandlers import DirectoryFileHandler
 from privacyscanner.exceptions import RetryScan
 
-from privacyscore.utils import get_worker_id
+from privacyscore.scanner.exceptions import RetryTest
+from privacyscore.scanner.ratelimit import throttle
+from privacyscore.utils import get_process_tree_memory, \
+    get_registered_domain, get_worker_id, register_persistent_process, \
+    unregister_persistent_process
 
 
 test_name = 'openwpm'
 test_dependencies = [
     'network',
 ]
+test_inputs = [
+    'a_records', 'dns_error', 'final_url', 'final_url_is_https', 'reachable',
+]
+test_max_attempts = 3
+
+# The debugging port of the browser of worker id 0
+CHROME_START_PORT = 9222
+
+# The maximum number of seconds to wait for the browser to manage its
+# browser contexts
+CHROME_TIMEOUT = 10
+
+
+class _ContextBrowser(pychrome.Browser):
+    """
+    A browser opening its tabs in a browser context of its own. Browser
+    contexts share no cookies, storage, caches, HSTS state or service
+    workers with each other.
+    """
+    def __init__(self, url: str, target: pychrome.Tab, context_id: str):
+        super().__init__(url)
+        self.context_id = context_id
+        self._target = target
+
+    def new_tab(self, url=None, timeout=None) -> pychrome.Tab:
+        target_id = self._target.Target.createTarget(
+            url=url or 'about:blank', browserContextId=self.context_id,
+            _timeout=CHROME_TIMEOUT)['targetId']
+        tab = pychrome.Tab(
+            id=target_id, type='page',
+            webSocketDebuggerUrl='ws://{}/devtools/page/{}'.format(
+                urlparse(self.dev_url).netloc, target_id))
+        self._tabs[tab.id] = tab
+        return tab
+
+
+class _PooledBrowser:
+    """
+    A browser which is reused for the scans of a worker process.
+
+    The browser is started like privacyscanner's ChromeBrowser does. It is
+    registered as a persistent process, so it is not killed when a task of
+    the worker times out.
+
+    The pid of the browser is stored in a file per debugging port. A browser
+    left behind by a worker process which has been killed is stopped before
+    a new browser is started on its port.
+    """
+    def __init__(self, worker_id: int):
+        self.worker_id = worker_id
+        self.scans = 0
+        self.failed = False
+        self._process = None
+        self._target = None
+        self._pid_file = Path(tempfile.gettempdir()) / \
+            'privacyscore-chrome-{}.pid'.format(CHROME_START_PORT + worker_id)
+        self._temp_dir = tempfile.TemporaryDirectory()
+        try:
+            self._stop_orphan(CHROME_START_PORT + worker_id)
+            self._start_chrome(CHROME_START_PORT + worker_id)
+        except Exception:
+            self.close()
+            raise
+
+    def _stop_orphan(self, debugging_port: int):
+        try:
+            pid = int(self._pid_file.read_text())
+            with open('/proc/{}/cmdline'.format(pid), 'rb') as f:
+                args = f.read().decode(errors='replace').split('\0')
+        except (OSError, ValueError):
+            return
+        if '--remote-debugging-port={}'.format(debugging_port) not in args:
+            # the pid has been reused by another process
+            return
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        for arg in args:
+            if arg.startswith('--user-data-dir='):
+                # the profile is in the temporary directory of the browser
+                shutil.rmtree(
+                    os.path.dirname(arg[len('--user-data-dir='):]),
+                    ignore_errors=True)
+
+    def _start_chrome(self, debugging_port: int):
+        user_data_dir = Path(self._temp_dir.name) / 'chrome-profile'
+        (user_data_dir / 'Default').mkdir(parents=True)
+        with (user_data_dir / 'Default' / 'Preferences').open('w') as f:
+            json.dump(PREFS, f)
+
+        program = shutil.which('google-chrome') or shutil.which('chromium')
+        if program is None:
+            raise ChromeBrowserStartupError(
+                'Could not find google-chrome or chromium.')
+        self._process = subprocess.Popen(
+            [program] + CHROME_OPTIONS + [
+                '--remote-debugging-port={}'.format(debugging_port),
+                '--user-data-dir={}'.format(user_data_dir),
+            ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        register_persistent_process(self._process.pid)
+        self._pid_file.write_text(str(self._process.pid))
+
+        self.browser = pychrome.Browser(
+            url='http://127.0.0.1:{}'.format(debugging_port))
+        # Wait until Chrome is ready
+        for _ in range(100):
+            try:
+                version = self.browser.version()
+                break
+            except ConnectionError:
+                time.sleep(0.1)
+        else:
+            raise ChromeBrowserStartupError('Could not connect to Chrome')
+
+        # The browser target manages the browser contexts of the scans.
+        self._target = pychrome.Tab(
+            id='browser', type='browser',
+            webSocketDebuggerUrl=version['webSocketDebuggerUrl'])
+        self._target.start()
+
+    def is_alive(self) -> bool:
+        return self._process.poll() is None
+
+    def memory_usage(self) -> int:
+        """Get the resident memory of the browser and its child processes
+        in bytes."""
+        return get_process_tree_memory(self._process.pid)
+
+    @contextmanager
+    def context(self) -> Iterator[_ContextBrowser]:
+        """
+        Get a browser whose tabs share no state with the tabs of other
+        scans. All state of the scan is removed afterwards.
+
+        If the browser context can not be disposed of, the browser is marked
+        as failed, as it may still hold the state of the scan.
+        """
+        context_id = self._target.Target.createBrowserContext(
+            _timeout=CHROME_TIMEOUT)['browserContextId']
+        try:
+            yield _ContextBrowser(self.browser.dev_url, self._target,
+                                  context_id)
+        finally:
+            try:
+                self._target.Target.disposeBrowserContext(
+                    browserContextId=context_id, _timeout=CHROME_TIMEOUT)
+            except Exception:
+                self.failed = True
+
+    def close(self):
+        if self._target is not None:
+            self._target.stop()
+        if self._process is not None:
+            self._process.terminate()
+            try:
+                self._process.wait(1)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+                self._process.wait()
+            unregister_persistent_process(self._process.pid)
+            try:
+                self._pid_file.unlink()
+            except OSError:
+                pass
+        self._temp_dir.cleanup()
+
+
+class _BrowserPool:
+    """
+    The browser of the current worker process.
 
+    Each worker process of a host keeps its browser running between scans.
+    The worker id, which determines the debugging port of the browser, is
+    held as long as the process lives, so the ports never collide. A browser
+    is replaced after max_scans scans, when its memory usage exceeds
+    max_memory megabytes or after it failed.
+    """
+    def __init__(self):
+        self._worker_id_lock = None
+        self._worker_id = None
+        self._browser = None
+
+    def acquire(self, max_scans: int, max_memory: int) -> _PooledBrowser:
+        if self._browser is not None and (
+                self._browser.failed or
+                not self._browser.is_alive() or
+                self._browser.scans >= max_scans or
+                self._browser.memory_usage() > max_memory * 1024 * 1024):
+            self.discard()
+        if self._browser is None:
+            if self._worker_id_lock is None:
+                self._worker_id_lock = get_worker_id()
+                self._worker_id = self._worker_id_lock.__enter__()
+            self._browser = _PooledBrowser(self._worker_id)
+        return self._browser
+
+    def discard(self):
+        """Stop the browser. A new one is started by the next scan."""
+        if self._browser is not None:
+            browser = self._browser
+            self._browser = None
+            browser.close()
+
+
+_browser_pool = _BrowserPool()
+# Worker processes of celery's prefork pool exit without running the atexit
+# handlers.
+atexit.register(_browser_pool.discard)
+
+
+@worker_process_shutdown.connect
+def _discard_browser(**kwargs):
+    _browser_pool.discard()
+
+
+def _scan_site(scanner_result: Result, attempt: int, max_scans: int,
+               max_memory: int):
+    """Scan a site with the browser of this worker process. This mirrors
+    privacyscanner's ChromeScan, which starts a new browser for every scan.
+    The browser is discarded if the scan fails, e.g. by the timeout of the
+    test suite."""
+    logger = logging.getLogger()
+    chrome_error = None
+    try:
+        browser = _browser_pool.acquire(max_scans, max_memory)
+        with browser.context() as context:
+            PageScanner(EXTRACTOR_CLASSES).scan(
+                context, scanner_result, logger, {})
+    except (pychrome.TimeoutException, ChromeBrowserStartupError) as e:
+        _browser_pool.discard()
+        if attempt == 1:
+            raise RetryScan('Chrome timeout or startup problem.')
+        if isinstance(e, pychrome.TimeoutException):
+            chrome_error = 'timeout'
+        else:
+            chrome_error = 'startup_problem'
+    except Exception:
+        _browser_pool.discard()
+        raise
+    else:
+        browser.scans += 1
+        if browser.failed:
+            _browser_pool.discard()
+    scanner_result['chrome_error'] = chrome_error
+
+
+def test_site(url: str, previous_results: dict, scan_basedir: str, virtualenv_path: str,
+              browser_max_scans: int = 50, browser_max_memory: int = 2048,
+              store_crawldata: bool = False,
+              attempt: int = 1) -> Dict[str, Dict[str, Union[str, bytes]]]:
+    """
+    Test a site using openwpm and related tests.
 
-def test_site(url: str, previous_results: dict, scan_basedir: str, virtualenv_path: str) -> Dict[str, Dict[str, Union[str, bytes]]]:
-    """Test a site using openwpm and related tests."""
+    Only the summary of the crawl data used by process_test_data is stored,
+    unless store_crawldata is set.
+    """
 
     result = {
         'raw_url': {
@@ -45,6 +309,8 @@ def test_site(url: str, previous_results: dict, scan_basedir: str, virtualenv_pa
         #print("Skipping OpenWPM due to previous error")
         return result
 
+    throttle(urlparse(url).hostname, previous_results.get('a_records', []))
+
     # ensure basedir exists
     if not os.path.isdir(scan_basedir):
         os.mkdir(scan_basedir)
@@ -54,25 +320,19 @@ def test_site(url: str, previous_results: dict, scan_basedir: str, virtualenv_pa
     os.mkdir(scan_dir)
 
     file_handler = DirectoryFileHandler(scan_dir)
-    logger = logging.getLogger()
-    num_tries = 1
-    while True:
-        try:
-            scanner_result = Result({'site_url': url}, file_handler)
-            with get_worker_id() as worker_id:
-                meta = ScanMeta(worker_id=worker_id, num_tries=num_tries)
-                scan_site(scanner_result, logger, {}, meta)
-            break
-        except RetryScan:
-            if num_tries >= 3:
-                result['crawldata'] = {
-                    'mime_type': 'application/json',
-                    'data': json.dumps(None).encode(),
-                }
-                return result
-
-            num_tries += 1
-            time.sleep(10)
+    try:
+        scanner_result = Result({'site_url': url}, file_handler)
+        _scan_site(scanner_result, attempt, browser_max_scans,
+                   browser_max_memory)
+    except RetryScan as e:
+        shutil.rmtree(scan_dir)
+        if attempt < test_max_attempts:
+            raise RetryTest(str(e))
+        result['crawlsummary'] = {
+            'mime_type': 'application/json',
+            'data': json.dumps(None).encode(),
+        }
+        return result
 
     # screenshot
     if os.path.isfile(os.path.join(scan_dir, 'files/screenshot.png')):
@@ -83,27 +343,26 @@ def test_site(url: str, previous_results: dict, scan_basedir: str, virtualenv_pa
             }
 
     # crawl result
-    result['crawldata'] = {
+    crawl_data = scanner_result.get_results()
+    if store_crawldata:
+        result['crawldata'] = {
+            'mime_type': 'application/json',
+            'data': json.dumps(crawl_data).encode(),
+        }
+    result['crawlsummary'] = {
         'mime_type': 'application/json',
-        'data': json.dumps(scanner_result.get_results()).encode(),
+        'data': json.dumps(_summarize_crawl_data(crawl_data)).encode(),
     }
 
-    # cropped and pixelized screenshot
-    if 'screenshot' in result:
-        out = BytesIO()
-        pixelize_screenshot(BytesIO(result['screenshot']['data']), out)
-        result['cropped_screenshot'] = {
-            'mime_type': 'image/png',
-            'data': out.getvalue(),
-        }
-
     # recursively delete scan folder
     shutil.rmtree(scan_dir)
 
     return result
 
 
-def process_test_data(raw_data: list, previous_results: dict, scan_basedir: str, virtualenv_path: str) -> Dict[str, Dict[str, object]]:
+def process_test_data(raw_data: list, previous_results: dict, scan_basedir: str, virtualenv_path: str,
+                      browser_max_scans: int = 50, browser_max_memory: int = 2048,
+                      store_crawldata: bool = False) -> Dict[str, Dict[str, object]]:
     """Process the raw data of the test."""
 
     # TODO: Clean up collection
@@ -125,7 +384,13 @@ def process_test_data(raw_data: list, previous_results: dict, scan_basedir: str,
         scantosave['openwpm_skipped_due_to_not_reachable'] = True
         return scantosave
 
-    crawl_data = json.loads(raw_data['crawldata']['data'].decode())
+    # The summary is much smaller than the complete crawl data of sites
+    # with many requests. Results of earlier scans have the complete crawl
+    # data only.
+    if 'crawlsummary' in raw_data:
+        crawl_data = json.loads(raw_data['crawlsummary']['data'].decode())
+    else:
+        crawl_data = json.loads(raw_data['crawldata']['data'].decode())
 
     if crawl_data is None:
         return scantosave
@@ -267,7 +532,7 @@ def process_test_data(raw_data: list, previous_results: dict, scan_basedir: str,
         for cookie in crawl_data['cookies']:
             d = dict((k, cookie.get(v)) for (k, v) in cookies_mapping.items())
             d['lifetime'] = cookie['lifetime']
-            d['baseDomain'] = tldextract.extract(cookie['domain']).registered_domain
+            d['baseDomain'] = get_registered_domain(cookie['domain'])
             cookies.append(d)
         scantosave['profilecookies'] = cookies
 
@@ -286,30 +551,25 @@ def process_test_data(raw_data: list, previous_results: dict, scan_basedir: str,
     return scantosave
 
 
-def pixelize_screenshot(screenshot, screenshot_pixelized, target_width=390, pixelsize=3):
-    """
-    Thumbnail a screenshot to `target_width` and pixelize it.
-
-    :param screenshot: Screenshot to be thumbnailed in pixelized
-    :param screenshot_pixelized: File to which the result should be written
-    :param target_width: Width of the final thumbnail
-    :param pixelsize: Size of the final pixels
-    :return: None
-    """
-    if target_width % pixelsize != 0:
-        raise ValueError("pixelsize must divide target_width")
-
-    img = Image.open(screenshot)
-    width, height = img.size
-    if height > width:
-        img = img.crop((0, 0, width, width))
-        height = width
-    undersampling_width = target_width // pixelsize
-    ratio = width / height
-    new_height = int(undersampling_width / ratio)
-    img = img.resize((undersampling_width, new_height), Image.BICUBIC)
-    img = img.resize((target_width, new_height * pixelsize), Image.NEAREST)
-    img.save(screenshot_pixelized, format='png')
+def _summarize_crawl_data(crawl_data: dict) -> dict:
+    """Get the parts of the crawl data used by process_test_data."""
+    summary = {
+        key: crawl_data[key] for key in (
+            'site_url', 'chrome_error', 'third_parties', 'tracking',
+            'google_analytics', 'security_headers', 'insecure_content')
+        if key in crawl_data
+    }
+    if 'requests' in crawl_data:
+        summary['requests'] = [
+            {'url': request.get('url')} for request in crawl_data['requests']]
+    if 'cookies' in crawl_data:
+        cookie_keys = (
+            'name', 'value', 'domain', 'path', 'expires', 'secure',
+            'httpOnly', 'lifetime')
+        summary['cookies'] = [
+            {key: cookie[key] for key in cookie_keys if key in cookie}
+            for cookie in crawl_data['cookies']]
+    return summary
 
 
 def detect_cookies(domain, cookies, flashcookies, trackers):
@@ -331,19 +591,21 @@ def detect_cookies(domain, cookies, flashcookies, trackers):
     tp_track      = 0  # Third party cookies from known trackers
     tp_track_uniq = 0  # Number of unique tracking domains that set cookies
 
-    dom_ext = tldextract.extract(domain)
+    registered_domain = get_registered_domain(domain)
+    tracker_domains = set(get_registered_domain(t) for t in trackers)
     seen_trackers = []
+    seen_tracker_domains = set()
 
     for cookie in cookies:
-        cd_ext = tldextract.extract(cookie["baseDomain"])
-        if cd_ext.registered_domain == dom_ext.registered_domain:
+        cookie_domain = get_registered_domain(cookie["baseDomain"])
+        if cookie_domain == registered_domain:
             fp = True # fp: first party
         else:
             fp = False
-            tds = [tldextract.extract(t).registered_domain for t in trackers]
-            if cd_ext.registered_domain in tds:
-                if cd_ext.registered_domain not in seen_trackers:
-                    seen_trackers.append(cd_ext.registered_domain)
+            if cookie_domain in tracker_domains:
+                if cookie_domain not in seen_tracker_domains:
+                    seen_tracker_domains.add(cookie_domain)
+                    seen_trackers.append(cookie_domain)
                     tp_track_uniq += 1
                 tp_track += 1
 
@@ -1,48 +1,72 @@
 """
 Test for common server leaks.
 """
+import codecs
 import json
 import re
-from typing import Dict, Union
+import time
+from http.cookiejar import DefaultCookiePolicy
+from typing import Dict, Iterable, List, Set, Tuple, Union
 from urllib.parse import urlparse
-from tldextract import extract
 import requests
-from requests.exceptions import ConnectionError
+from requests.exceptions import RequestException
 from requests.models import Response
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from privacyscore.scanner.deadline import Deadline, DeadlineAdapter
+from privacyscore.scanner.exceptions import RateLimitExceeded
+from privacyscore.scanner.ratelimit import throttle
+from privacyscore.utils import extract_domain
 
 
 test_name = 'serverleak'
 test_dependencies = [
     'network', 'openwpm', 'testssl_https', 'testssl_mx',
 ]
+test_inputs = ['a_records']
+# The test is rescheduled when the rate limits of the site are exceeded.
+test_max_attempts = 3
 
 USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64; rv:61.0) Gecko/20100101 Firefox/61.0 (Research project: Visit PrivacyScore.org for details)'
 
+# Only the top of each file is read because core dumps can become very large.
+# Also, we do not want to store more potentially sensitive data than
+# necessary to determine whether there is a leak or not.
+TRIAL_MAX_CONTENT_SIZE = 50 * 1024
+# The maximum time in seconds spent on a trial including its content. The
+# content read until then is kept.
+TRIAL_TIME_BUDGET = 30
+TRIAL_CHUNK_SIZE = 4096
+
+# The number of concurrent requests to a site is adapted to its latency and
+# errors: it is increased by one after each fast response and halved after
+# each slow or failed one.
+PROBE_MIN_CONCURRENCY = 1
+PROBE_INITIAL_CONCURRENCY = 4
+PROBE_MAX_CONCURRENCY = 8
+# The latency in seconds above which a response is considered slow
+PROBE_SLOW_LATENCY = 3
+
 
-def _match_db_dump(content):
-    targets = ["SQLite", "CREATE TABLE", "INSERT INTO", "DROP TABLE"]
-    matched = False
-    for target in targets:
-        matched |= target in content
-    return matched
+# A database dump is detected if any of these strings is contained
+DB_DUMP_SIGNATURES = ('SQLite', 'CREATE TABLE', 'INSERT INTO', 'DROP TABLE')
 
 def _concat_sub(url, suffix):
-    url_extract = extract(url)
+    url_extract = extract_domain(url)
     if url_extract.subdomain == "":
         return None
     site = url_extract.subdomain + "." + url_extract.domain
     return site + suffix
 
 def _concat_full(url, suffix):
-    url_extract = extract(url)
+    url_extract = extract_domain(url)
     site = url_extract.domain + "." + url_extract.suffix
     if url_extract.subdomain != "":
         site = url_extract.subdomain + "." + site
     return site + suffix
 
 def _gen_db_domain_sql(url):
-    return extract(url).domain + ".sql"
+    return extract_domain(url).domain + ".sql"
 
 def _gen_db_sub_domain_sql(url):
     return _concat_sub(url, ".sql")
@@ -51,7 +75,7 @@ def _gen_db_full_domain_sql(url):
     return _concat_full(url, ".sql")
 
 def _gen_db_domain_db(url):
-    return extract(url).domain + ".db"
+    return extract_domain(url).domain + ".db"
 
 def _gen_db_sub_domain_db(url):
     return _concat_sub(url, ".db")
@@ -60,7 +84,7 @@ def _gen_db_full_domain_db(url):
     return _concat_full(url, ".db")
 
 def _gen_db_domain_key(url):
-    return extract(url).domain + ".key"
+    return extract_domain(url).domain + ".key"
 
 def _gen_db_sub_domain_key(url):
     return _concat_sub(url, ".key")
@@ -69,7 +93,7 @@ def _gen_db_full_domain_key(url):
     return _concat_full(url, ".key")
 
 def _gen_db_domain_pem(url):
-    return extract(url).domain + ".pem"
+    return extract_domain(url).domain + ".pem"
 
 def _gen_db_sub_domain_pem(url):
     return _concat_sub(url, ".pem")
@@ -89,20 +113,20 @@ TRIALS = [
 
     ### Check for Database dumps
     # sqldump - mysql
-    ('dump.db', _match_db_dump),
-    ('dump.sql', _match_db_dump),
-    ('sqldump.sql', _match_db_dump),
-    ('sqldump.db', _match_db_dump),
+    ('dump.db', DB_DUMP_SIGNATURES),
+    ('dump.sql', DB_DUMP_SIGNATURES),
+    ('sqldump.sql', DB_DUMP_SIGNATURES),
+    ('sqldump.db', DB_DUMP_SIGNATURES),
     # SQLite
-    ('db.sqlite', _match_db_dump),
-    ('data.sqlite', _match_db_dump),
-    ('sqlite.db', _match_db_dump),
-    (_gen_db_domain_sql, _match_db_dump),
-    (_gen_db_sub_domain_sql, _match_db_dump),
-    (_gen_db_full_domain_sql, _match_db_dump),
-    (_gen_db_domain_db, _match_db_dump),
-    (_gen_db_sub_domain_db, _match_db_dump),
-    (_gen_db_full_domain_db, _match_db_dump),
+    ('db.sqlite', DB_DUMP_SIGNATURES),
+    ('data.sqlite', DB_DUMP_SIGNATURES),
+    ('sqlite.db', DB_DUMP_SIGNATURES),
+    (_gen_db_domain_sql, DB_DUMP_SIGNATURES),
+    (_gen_db_sub_domain_sql, DB_DUMP_SIGNATURES),
+    (_gen_db_full_domain_sql, DB_DUMP_SIGNATURES),
+    (_gen_db_domain_db, DB_DUMP_SIGNATURES),
+    (_gen_db_sub_domain_db, DB_DUMP_SIGNATURES),
+    (_gen_db_full_domain_db, DB_DUMP_SIGNATURES),
 
     # TODO PostgreSQL etc., additional common names
 
@@ -122,16 +146,236 @@ TRIALS = [
     # TODO Add [domainname].key, [domainname].pem
 ]
 
-def _get(url, timeout):
-    try:
-        response = requests.get(url, headers={
-            'User-Agent': USER_AGENT
-        }, timeout=timeout)
-        return response
-    except ConnectionError:
+
+_REGEX_TYPE = type(re.compile(''))
+
+
+def _trie_regex(words: Iterable[str]) -> str:
+    """
+    Build a regular expression matching any of words. The alternatives are
+    arranged as a trie, so the work per position of the text depends on the
+    length of the words rather than on their number. Longer words are
+    preferred over their prefixes.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def _build(node: dict) -> str:
+        branches = [re.escape(char) + _build(child)
+                    for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        if len(branches) == 1 and '' not in node:
+            return branches[0]
+        regex = '(?:{})'.format('|'.join(branches))
+        if '' in node:
+            regex += '?'
+        return regex
+
+    return _build(trie)
+
+
+class _SignatureMatcher:
+    """
+    Match the signatures of all trials against a response.
+
+    A pattern of a trial is either a string which has to be contained in
+    the response, a compiled regular expression which has to be found in the
+    response, a tuple of patterns of which any has to match, or a callable
+    which is called with the response text.
+
+    All strings are found in a single pass over the response. Regular
+    expressions and callables are evaluated separately.
+    """
+    def __init__(self, patterns: Iterable):
+        literals = set()
+        for pattern in patterns:
+            literals.update(self._literals(pattern))
+
+        self._regex = None
+        if literals:
+            # The lookahead finds overlapping occurrences.
+            self._regex = re.compile(
+                '(?=({}))'.format(_trie_regex(literals)))
+        # Only the longest string is reported for each position, so its
+        # prefixes have been found as well.
+        self._prefixes = {
+            literal: {prefix for prefix in literals
+                      if literal.startswith(prefix)}
+            for literal in literals
+        }
+
+    def matches(self, pattern, text: str) -> bool:
+        """Check whether pattern matches text."""
+        return self._matches(pattern, text, self.find(text))
+
+    def overlap(self, pattern) -> Union[int, None]:
+        """
+        Get the number of characters a match of pattern may share with the
+        text preceding it, i.e. the length of its longest string minus one.
+        None if pattern contains regular expressions or callables, which
+        have to be matched against the whole text.
+        """
+        if isinstance(pattern, str):
+            return max(len(pattern) - 1, 0)
+        if isinstance(pattern, tuple):
+            overlaps = [self.overlap(p) for p in pattern]
+            if None in overlaps:
+                return None
+            return max(overlaps, default=0)
         return None
 
-def test_site(url: str, previous_results: dict) -> Dict[str, Dict[str, Union[str, bytes]]]:
+    def find(self, text: str) -> Set[str]:
+        """Find all strings of the signatures which are contained in text."""
+        found = set()
+        if self._regex is not None:
+            for match in self._regex.finditer(text):
+                found.update(self._prefixes[match.group(1)])
+        return found
+
+    def _matches(self, pattern, text: str, found: Set[str]) -> bool:
+        if isinstance(pattern, str):
+            return pattern in found
+        if isinstance(pattern, tuple):
+            return any(self._matches(p, text, found) for p in pattern)
+        if isinstance(pattern, _REGEX_TYPE):
+            return pattern.search(text) is not None
+        if callable(pattern):
+            return bool(pattern(text))
+        return False
+
+    def _literals(self, pattern) -> Iterable[str]:
+        if isinstance(pattern, str):
+            return [pattern]
+        if isinstance(pattern, tuple):
+            return [literal for p in pattern for literal in self._literals(p)]
+        return []
+
+
+_signature_matcher = _SignatureMatcher(pattern for _, pattern in TRIALS)
+
+class _AdaptiveConcurrency:
+    """The number of concurrent requests to a site."""
+    def __init__(self):
+        self.limit = PROBE_INITIAL_CONCURRENCY
+
+    def success(self, latency: float):
+        if latency > PROBE_SLOW_LATENCY:
+            self.failure()
+        else:
+            self.limit = min(PROBE_MAX_CONCURRENCY, self.limit + 1)
+
+    def failure(self):
+        self.limit = max(PROBE_MIN_CONCURRENCY, self.limit // 2)
+
+
+_probe_executor = None
+
+
+def _get_probe_executor() -> ThreadPoolExecutor:
+    """Get the pool of threads requesting the trials. The pool is created
+    lazily, so it is not shared with forked worker processes."""
+    global _probe_executor
+    if _probe_executor is None:
+        _probe_executor = ThreadPoolExecutor(max_workers=PROBE_MAX_CONCURRENCY)
+    return _probe_executor
+
+
+def _get_session() -> requests.Session:
+    """Get a session keeping the connections to a site alive."""
+    session = requests.Session()
+    adapter = DeadlineAdapter(pool_maxsize=PROBE_MAX_CONCURRENCY)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['User-Agent'] = USER_AGENT
+    # every trial is requested without cookies
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+
+def _get(session: requests.Session, url: str, match_url: str, pattern,
+         timeout: int, addresses: Iterable[str] = ()) -> \
+        Tuple[Union[bytes, None], float]:
+    """
+    Request url and get the json representation of the response and the
+    latency of the response.
+
+    The content is streamed and reading stops as soon as the pattern matches,
+    after TRIAL_MAX_CONTENT_SIZE bytes or after TRIAL_TIME_BUDGET seconds.
+    The json is None if the request has been redirected.
+    """
+    throttle(urlparse(url).hostname, addresses)
+    start = time.monotonic()
+    with Deadline(TRIAL_TIME_BUDGET) as deadline:
+        try:
+            response = session.get(url, timeout=timeout, stream=True)
+        except RequestException as e:
+            if deadline.expired:
+                raise requests.exceptions.Timeout(
+                    'Requesting {} took too long'.format(url)) from e
+            raise
+
+        with response:
+            latency = response.elapsed.total_seconds()
+            if match_url not in response.url:
+                # There has been a redirect.
+                return None, latency
+
+            size = 0
+            text = []
+            # Only successful responses are checked for leaks.
+            if response.status_code == 200:
+                size = _read_content(response, pattern, text, deadline)
+
+            return _response_to_json(
+                response, ''.join(text), size,
+                time.monotonic() - start), latency
+
+
+def _read_content(response: Response, pattern, text: List[str],
+                  deadline: Deadline) -> int:
+    """
+    Read the content of response until pattern matches, the deadline expires
+    or TRIAL_MAX_CONTENT_SIZE bytes have been read. The decoded content is
+    appended to text. Returns the number of bytes read.
+
+    Only the text added by each chunk is matched, together with the end of
+    the previous text which may contain the start of a match.
+    """
+    overlap = _signature_matcher.overlap(pattern)
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    size = 0
+    tail = ''
+    try:
+        for chunk in response.iter_content(TRIAL_CHUNK_SIZE):
+            chunk = chunk[:TRIAL_MAX_CONTENT_SIZE - size]
+            size += len(chunk)
+            new_text = decoder.decode(chunk)
+            text.append(new_text)
+            if overlap is None:
+                # the pattern has to be matched against the whole text
+                window = ''.join(text)
+            else:
+                window = tail + new_text
+                tail = window[max(len(window) - overlap, 0):]
+            if (size >= TRIAL_MAX_CONTENT_SIZE or
+                    _signature_matcher.matches(pattern, window)):
+                break
+    except RequestException:
+        # The content read until the deadline is kept.
+        if not deadline.expired:
+            raise
+    finally:
+        text.append(decoder.decode(b'', final=True))
+    return size
+
+
+def test_site(url: str, previous_results: dict,
+              attempt: int = 1) -> Dict[str, Dict[str, Union[str, bytes]]]:
     raw_requests = {
         'url': {
             'mime_type': 'text/plain',
@@ -142,38 +386,59 @@ def test_site(url: str, previous_results: dict) -> Dict[str, Dict[str, Union[str
     # determine hostname
     parsed_url = urlparse(url)
 
-    with ThreadPoolExecutor(max_workers=8) as executor:
-        url_to_future = {}
-        for trial, pattern in TRIALS:
-            trial_t = trial
-            # Check if trial is callable. If so, call it and save the result
-            if callable(trial):
-                trial_t = trial(url)
-                if trial_t is None:
+    trials = {}
+    for trial, pattern in TRIALS:
+        trial_t = trial
+        # Check if trial is callable. If so, call it and save the result
+        if callable(trial):
+            trial_t = trial(url)
+            if trial_t is None:
+                continue
+        trials[trial_t] = pattern
+    trials = list(trials.items())
+
+    session = _get_session()
+    executor = _get_probe_executor()
+    concurrency = _AdaptiveConcurrency()
+    pending = {}
+    try:
+        while trials or pending:
+            while trials and len(pending) < concurrency.limit:
+                trial, pattern = trials.pop(0)
+                request_url = '{}://{}/{}'.format(
+                    parsed_url.scheme, parsed_url.netloc, trial)
+                match_url = '{}/{}'.format(parsed_url.netloc, trial)
+                future = executor.submit(
+                    _get, session, request_url, match_url, pattern, 10,
+                    previous_results.get('a_records', []))
+                pending[future] = trial
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                trial = pending.pop(future)
+                try:
+                    response, latency = future.result()
+                except RequestException:
+                    concurrency.failure()
+                    continue
+                except RateLimitExceeded:
+                    # The trial has not been run, so the site could not be
+                    # checked completely.
+                    raise
+                except Exception:
                     continue
-            request_url = '{}://{}/{}'.format(
-                parsed_url.scheme, parsed_url.netloc, trial_t)
-            url_to_future[trial_t] = executor.submit(_get, request_url, 10)
-
-        for trial in url_to_future:
-            try:
-                # response = requests.get(request_url, timeout=10)
-                response = url_to_future[trial].result()
+                concurrency.success(latency)
                 if response is None:
                     continue
 
-                match_url = '{}/{}'.format(parsed_url.netloc, trial)
-
-                if  match_url not in response.url:
-                    # There has been a redirect.
-                    continue
-                
                 raw_requests[trial] = {
                     'mime_type': 'application/json',
-                    'data': _response_to_json(response),
+                    'data': response,
                 }
-            except Exception:
-                continue
+    finally:
+        for future in pending:
+            future.cancel()
+        session.close()
 
     return raw_requests
 
@@ -197,33 +462,21 @@ def process_test_data(raw_data: list, previous_results: dict) -> Dict[str, Dict[
             continue
         response = json.loads(raw_data[trial]['data'].decode())
         if response['status_code'] == 200:
-            # The pattern can have three different types.
-            # - If it is a simple string, we only check if it is contained in the response
-            if isinstance(pattern, str):
-                if pattern in response['text']:
-                    leaks.append(trial)
-            # - If it is a RegEx object, we perform a pattern match
-            elif isinstance(pattern, re._pattern_type):
-                if re.match(response['text']):
-                    leaks.append(trial)
-            # - If it is callable, we call it with the response text and check the return value
-            elif callable(pattern):
-                if pattern(response['text']):
-                    leaks.append(trial)
+            if _signature_matcher.matches(pattern, response['text']):
+                leaks.append(trial)
 
     result['leaks'] = leaks
     return result
 
 
-def _response_to_json(resp: Response) -> bytes:
+def _response_to_json(resp: Response, text: str, content_size: int,
+                      elapsed: float) -> bytes:
     """Generate a json byte string from a response received through requests."""
-    # we store only the top of the file because core dumps can become very large
-    # also: we do not want to store more potentially sensitive data than necessary
-    # to determine whether there is a leak or not
-    
     return json.dumps({
-        'text': resp.content[0:50*1024].decode(errors='replace'),
+        'text': text,
         'status_code': resp.status_code,
         'headers': dict(resp.headers),
         'url': resp.url,
+        'content_size': content_size,
+        'elapsed': elapsed,
     }).encode()
@@ -1,21 +1,33 @@
 """
 Common functionality for testssl-based checks.
 """
+import json
 import os
 import re
 import tempfile
+from json.decoder import scanstring
 from pprint import pprint
+from typing import Iterator
 
-from subprocess import call, check_output, DEVNULL
+from subprocess import CalledProcessError, DEVNULL
 
 from django.conf import settings
 
+from privacyscore.utils import run_supervised
+
 from pprint import pprint
 
 
 TESTSSL_PATH = os.path.join(
     settings.SCAN_TEST_BASEPATH, 'vendor/testssl.sh', 'testssl.sh')
 
+# The sections of a scan result which are read by the test suites. All other
+# sections, i.e. the cipher tests and browser simulations, are skipped.
+SCAN_RESULT_SECTIONS = {
+    'serverDefaults', 'pfs', 'protocols', 'vulnerabilities', 'ciphers',
+    'headerResponse',
+}
+
 
 def run_testssl(hostname: str, check_mx: bool, remote_host: str = None) -> bytes:
     """Test the specified hostname with testssl and return the raw json result."""
@@ -25,12 +37,25 @@ def run_testssl(hostname: str, check_mx: bool, remote_host: str = None) -> bytes
     else:
         out = _local_testssl(hostname, check_mx)
 
-    # fix json syntax error
-    out = re.sub(r'"Invocation.*?\n', '', out.decode(), 1).encode()
-
     return out
 
 
+def load_testssl_result(data: bytes) -> dict:
+    """
+    Parse the json result of testssl.
+
+    Only the sections of the scan results listed in SCAN_RESULT_SECTIONS
+    are parsed; all other sections are skipped in a single pass over the
+    document.
+    """
+    try:
+        return _TestsslResultReader(data.decode(errors='replace')).read()
+    except (ValueError, IndexError):
+        # Fall back to parsing the complete document.
+        return json.loads(re.sub(
+            r'"Invocation.*?\n', '', data.decode('unicode_escape'), 1))
+
+
 def parse_common_testssl(json: str, prefix: str):
     """Perform common parsing tasks on result JSONs."""
     result = {
@@ -108,13 +133,129 @@ def parse_common_testssl(json: str, prefix: str):
 
     return result
 
+
+class _TestsslResultReader:
+    """A reader for the json documents written by testssl."""
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+    # Everything up to the next bracket. Strings are matched as a whole, so
+    # brackets within them are ignored.
+    SKIP = re.compile(r'[^"\[\]{}]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"\[\]{}]*)*')
+
+    def __init__(self, text: str):
+        self.text = text
+        self.pos = 0
+        self.decoder = json.JSONDecoder(strict=False)
+
+    def read(self) -> dict:
+        result = {}
+        for key in self._iter_object():
+            if key == 'scanResult':
+                result[key] = [
+                    self._read_scan_result() for _ in self._iter_array()]
+            elif key == 'Invocation':
+                # The command line is not escaped properly by some versions
+                # of testssl.
+                start = self.pos
+                try:
+                    result[key] = self._read_value()
+                    if self._peek() not in ',}':
+                        raise ValueError
+                except ValueError:
+                    result.pop(key, None)
+                    self.pos = self.text.index('\n', start) + 1
+            else:
+                result[key] = self._read_value()
+        return result
+
+    def _read_scan_result(self) -> dict:
+        result = {}
+        for key in self._iter_object():
+            if key in SCAN_RESULT_SECTIONS or self._peek() not in '[{':
+                result[key] = self._read_value()
+            else:
+                self._skip_value()
+        return result
+
+    def _iter_object(self) -> Iterator[str]:
+        """Iterate over the keys of an object. The value of each key has to
+        be consumed before the next key is read."""
+        self._expect('{')
+        if self._peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            self._expect('"')
+            key, self.pos = scanstring(self.text, self.pos, False)
+            self._expect(':')
+            yield key
+            char = self._peek()
+            if char == '}':
+                self.pos += 1
+                return
+            if char == ',':
+                self.pos += 1
+            elif char != '"':
+                # a comma is missing after a skipped Invocation line
+                raise ValueError('Unexpected {!r} at {}'.format(char, self.pos))
+
+    def _iter_array(self) -> Iterator[None]:
+        """Iterate over the elements of an array. Each element has to be
+        consumed before the next iteration."""
+        self._expect('[')
+        if self._peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield
+            char = self._peek()
+            self.pos += 1
+            if char == ']':
+                return
+            if char != ',':
+                raise ValueError('Unexpected {!r} at {}'.format(char, self.pos))
+
+    def _read_value(self):
+        self._peek()
+        value, self.pos = self.decoder.raw_decode(self.text, self.pos)
+        return value
+
+    def _skip_value(self):
+        """Skip an array or object without decoding it."""
+        depth = 0
+        while True:
+            self.pos = self.SKIP.match(self.text, self.pos).end()
+            char = self.text[self.pos]
+            self.pos += 1
+            if char in '[{':
+                depth += 1
+            elif char in ']}':
+                depth -= 1
+                if depth == 0:
+                    return
+            else:
+                raise ValueError('Unterminated string at {}'.format(self.pos))
+
+    def _peek(self) -> str:
+        self.pos = self.WHITESPACE.match(self.text, self.pos).end()
+        return self.text[self.pos]
+
+    def _expect(self, char: str):
+        if self._peek() != char:
+            raise ValueError('Expected {!r} at {}'.format(char, self.pos))
+        self.pos += 1
+
+
 def _remote_testssl(hostname: str, remote_host: str) -> bytes:
     """Run testssl over ssh."""
-    return check_output([
+    args = [
         'ssh',
         remote_host,
         hostname,
-    ])
+    ]
+    returncode, out, _ = run_supervised(args, stderr=DEVNULL)
+    if returncode != 0:
+        raise CalledProcessError(returncode, args, out)
+    return out
 
 
 def _local_testssl(hostname: str, check_mx: bool) -> bytes:
@@ -147,7 +288,7 @@ def _local_testssl(hostname: str, check_mx: bool) -> bytes:
     else:
         args.append(hostname)
 
-    call(args, stdout=DEVNULL, stderr=DEVNULL)
+    run_supervised(args, stdout=DEVNULL, stderr=DEVNULL)
 
     # exception when file does not exist.
     with open(result_file, 'rb') as file:
@@ -5,21 +5,32 @@ Test the SSL configuration of the web server.
 import json
 import re
 import os
-from typing import Dict, Union
+import threading
+from typing import Dict, FrozenSet, Tuple, Union
 from urllib.parse import urlparse
 
+from dns.exception import DNSException
 from django.conf import settings
+from privacyscore.scanner.ratelimit import throttle
+from privacyscore.scanner.resolver import get_resolver
 from privacyscore.utils import get_list_item_by_dict_entry
 
-from .testssl.common import run_testssl, parse_common_testssl
+from .testssl.common import load_testssl_result, run_testssl, \
+    parse_common_testssl
 
 test_name = 'testssl_https'
 test_dependencies = [
     'network',
 ]
+test_inputs = [
+    'a_records', 'final_https_url', 'final_url_is_https',
+    'same_content_via_https',
+]
+# The test is rescheduled if the rate limits do not allow scanning the host.
+test_max_attempts = 3
 
 
-def test_site(url: str, previous_results: dict) -> Dict[str, Dict[str, Union[str, bytes]]]:
+def test_site(url: str, previous_results: dict, attempt: int = 1) -> Dict[str, Dict[str, Union[str, bytes]]]:
     # Commented out for now because it gives bad results sometimes
     scan_url = previous_results.get('final_https_url')
     if scan_url and (previous_results.get('same_content_via_https') or previous_results.get('final_url_is_https')):
@@ -37,6 +48,14 @@ def test_site(url: str, previous_results: dict) -> Dict[str, Dict[str, Union[str
     #hostname = urlparse(scan_url).hostname
 
     # hostname = urlparse(url).hostname
+    addresses = previous_results.get('a_records', [])
+    if hostname != urlparse(url).hostname:
+        # redirected to another host
+        try:
+            addresses = get_resolver().query(hostname, 'A')
+        except DNSException:
+            addresses = []
+    throttle(hostname, addresses)
     jsonresult = run_testssl(hostname, False)
 
     return {
@@ -54,8 +73,7 @@ def process_test_data(raw_data: list, previous_results: dict) -> Dict[str, Dict[
         rv['web_has_ssl'] = False
         return rv
 
-    data = json.loads(
-        raw_data['jsonresult']['data'].decode('unicode_escape'))
+    data = load_testssl_result(raw_data['jsonresult']['data'])
 
     if not 'scanResult' in data:
         # something went wrong with this test.
@@ -78,20 +96,56 @@ def process_test_data(raw_data: list, previous_results: dict) -> Dict[str, Dict[
     return result
 
 
-def _detect_hsts(data: dict) -> dict:
-    def _check_contained(preloads, domain, subdomains=False):
-        for entry in preloads["entries"]:
-            if entry["name"] == domain:
-                if subdomains:
-                    try:
-                        if entry["include_subdomains"]:
-                            return True
-                    except:
-                        pass
-                else:
-                    return True
-        return False
+class _HSTSPreloadIndex:
+    """
+    The names of the HSTS preload list, loaded once per worker process and
+    reloaded when the list is replaced.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._names = frozenset()
+        self._subdomain_names = frozenset()
+        self._stat = None
+        self._lock = threading.Lock()
+
+    def is_preloaded(self, host: str) -> bool:
+        """Check whether host is covered by an entry of the preload list."""
+        names, subdomain_names = self._load()
+        if host in names:
+            return True
+        # Look for policies on parent domains that include subdomains
+        labels = host.split('.')
+        return any('.'.join(labels[i:]) in subdomain_names
+                   for i in range(1, len(labels)))
+
+    def _load(self) -> Tuple[FrozenSet[str], FrozenSet[str]]:
+        stat = os.stat(self.path)
+        stat = (stat.st_ino, stat.st_mtime, stat.st_size)
+        with self._lock:
+            if stat != self._stat:
+                with open(self.path) as fo:
+                    entries = json.load(fo)['entries']
+                self._names = frozenset(entry['name'] for entry in entries)
+                self._subdomain_names = frozenset(
+                    entry['name'] for entry in entries
+                    if entry.get('include_subdomains'))
+                self._stat = stat
+            return self._names, self._subdomain_names
+
+
+_hsts_preload_index = None
+
+
+def _get_hsts_preload_index() -> _HSTSPreloadIndex:
+    global _hsts_preload_index
+    if _hsts_preload_index is None:
+        _hsts_preload_index = _HSTSPreloadIndex(os.path.join(
+            settings.SCAN_TEST_BASEPATH, "vendor/HSTSPreload",
+            "transport_security_state_static"))
+    return _hsts_preload_index
+
 
+def _detect_hsts(data: dict) -> dict:
     result = {}
 
     hsts_item = get_list_item_by_dict_entry(
@@ -121,22 +175,8 @@ def _detect_hsts(data: dict) -> dict:
         result["web_has_hsts_header_sufficient_time"] = hsts_time_item['severity'] == 'OK'
 
     # Check the HSTS Preloading database
-    result["web_has_hsts_preload"] = False
-    with open(os.path.join(settings.SCAN_TEST_BASEPATH, "vendor/HSTSPreload", "transport_security_state_static")) as fo:
-        preloads = json.loads(fo.read())
-    host = data["target host"]
-    # Check if exact hostname is included
-    if not _check_contained(preloads, host):
-        # If not included, construct ever shorter hostnames and look for policies
-        # on those versions that include subdomains
-        split = host.split(".")
-        for i in range(1, len(split)):
-            if _check_contained(preloads, ".".join(split[i:]), True):
-                # Found
-                result["web_has_hsts_preload"] = True
-    else:
-        # Found
-        result["web_has_hsts_preload"] = True
+    result["web_has_hsts_preload"] = _get_hsts_preload_index().is_preloaded(
+        data["target host"])
     return result
 
 
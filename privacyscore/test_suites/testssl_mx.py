@@ -1,22 +1,36 @@
 """
 Test the TLS configuration of the mail server, if one exists.
+
+Many sites share the same mail servers. If cache_ttl is configured, the raw
+result of a mail server is cached for cache_ttl seconds and reused for all
+sites using this mail server. Only results which can be processed are cached.
 """
 
-import json
 import re
 from typing import Dict, Union
 from urllib.parse import urlparse
 
-from .testssl.common import run_testssl, parse_common_testssl
+from django.conf import settings
+
+from privacyscore.scanner.cache import get_shared_cache
+from privacyscore.scanner.ratelimit import throttle
+
+from .testssl.common import load_testssl_result, run_testssl, \
+    parse_common_testssl
 
 test_name = 'testssl_mx'
 test_dependencies = ['network']
+test_inputs = ['mx_records', 'mx_a_records']
+# The test is rescheduled if the rate limits do not allow scanning the host.
+test_max_attempts = 3
 
 
-def test_site(url: str, previous_results: dict, remote_host: str = None) -> Dict[str, Dict[str, Union[str, bytes]]]:
+def test_site(url: str, previous_results: dict, remote_host: str = None,
+              cache_ttl: int = 0, attempt: int = 1) -> Dict[str, Dict[str, Union[str, bytes]]]:
     # test first mx
     try:
         hostname = previous_results['mx_records'][0][1]
+        addresses = previous_results['mx_a_records'][0][1]
     except (KeyError, IndexError):
         return {
             'jsonresult': {
@@ -25,7 +39,16 @@ def test_site(url: str, previous_results: dict, remote_host: str = None) -> Dict
             },
         }
 
-    jsonresult = run_testssl(hostname, True, remote_host)
+    def _run_testssl():
+        throttle(hostname, addresses)
+        return run_testssl(hostname, True, remote_host)
+
+    if cache_ttl:
+        jsonresult = get_shared_cache().get_or_compute(
+            'testssl_mx:{}'.format(hostname), _run_testssl, cache_ttl,
+            settings.SCAN_SUITE_TIMEOUT_SECONDS, _is_complete_result)
+    else:
+        jsonresult = _run_testssl()
 
     return {
         'jsonresult': {
@@ -35,15 +58,15 @@ def test_site(url: str, previous_results: dict, remote_host: str = None) -> Dict
     }
 
 
-def process_test_data(raw_data: list, previous_results: dict, remote_host: str = None) -> Dict[str, Dict[str, object]]:
+def process_test_data(raw_data: list, previous_results: dict, remote_host: str = None,
+                      cache_ttl: int = 0) -> Dict[str, Dict[str, object]]:
     """Process the raw data of the test."""
     result = {"mx_ssl_finished": True}
     if raw_data['jsonresult']['data'] == b'':
         result['mx_has_ssl'] = False
         return result
 
-    data = json.loads(
-        raw_data['jsonresult']['data'].decode())
+    data = load_testssl_result(raw_data['jsonresult']['data'])
     # Attempt at solving
     # try:
     #     data = json.loads(
@@ -62,3 +85,16 @@ def process_test_data(raw_data: list, previous_results: dict, remote_host: str =
 
     result.update(parse_common_testssl(data, "mx"))
     return result
+
+
+def _is_complete_result(jsonresult: bytes) -> bool:
+    """Check whether the json result of testssl can be processed."""
+    try:
+        data = load_testssl_result(jsonresult)
+        if not data['scanResult'] or not data['scanResult'][0]:
+            return False
+        parse_common_testssl(data, 'mx')
+    except Exception:
+        # incomplete results of timed out runs fail in various ways
+        return False
+    return True
@@ -4,13 +4,19 @@ Utility functions that are shared across different modules.
 import errno
 import fcntl
 import os
+import signal
+import subprocess
+from functools import lru_cache
 from pathlib import Path
 
-from pwd import getpwuid
-from typing import List, Tuple
+from typing import BinaryIO, List, Tuple
 
 from urllib.parse import urlparse
+from django.conf import settings
 from url_normalize import url_normalize
+from PIL import Image
+from tldextract import TLDExtract
+from tldextract.tldextract import ExtractResult
 
 
 def normalize_url(url: str) -> str:
@@ -30,6 +36,44 @@ def normalize_url(url: str) -> str:
     return normalized.split('?')[0]
 
 
+# The vendored snapshot of the public suffix list
+PUBLIC_SUFFIX_LIST_SNAPSHOT_PATH = os.path.join(
+    os.path.dirname(__file__), 'public_suffix_list.dat')
+
+
+def get_public_suffix_list_path() -> str:
+    """Get the path of the public suffix list, which is the list updated by
+    the updatepublicsuffixlist management command if it exists and the
+    vendored snapshot otherwise."""
+    path = getattr(settings, 'PUBLIC_SUFFIX_LIST_PATH', None)
+    if path and os.path.isfile(path):
+        return path
+    return PUBLIC_SUFFIX_LIST_SNAPSHOT_PATH
+
+
+@lru_cache(maxsize=None)
+def _get_tld_extract() -> TLDExtract:
+    # The suffix list is read from the file when the first domain is
+    # extracted, so no requests are made and no cache files are written.
+    return TLDExtract(
+        cache_dir=None,
+        suffix_list_urls=(Path(get_public_suffix_list_path()).as_uri(),),
+        fallback_to_snapshot=False)
+
+
+@lru_cache(maxsize=10000)
+def extract_domain(url: str) -> ExtractResult:
+    """Split the hostname of url into subdomain, domain and public suffix.
+    The results of recent calls are cached."""
+    return _get_tld_extract()(url)
+
+
+def get_registered_domain(url: str) -> str:
+    """Get the registered domain of the hostname of url, i.e. example.com
+    for https://www.example.com/. Empty if url has no registered domain."""
+    return extract_domain(url).registered_domain
+
+
 def get_raw_data_by_identifier(raw_data: list, identifier: str):
     """Get the first raw data element with the specified identifier."""
     return next((
@@ -42,14 +86,144 @@ def get_list_item_by_dict_entry(search: list, key: str, value: str):
         s for s in search if s[key] == value), None)
 
 
-def get_processes_of_user(user: str) -> List[Tuple[int, str]]:
-    """Get a tuple (pid, cmdline) for all processes of user."""
-    return [
-        (int(pid),
-         open('/proc/{}/cmdline'.format(pid), 'r').read())
-        for pid in os.listdir('/proc')
-        if (pid.isdigit() and
-            getpwuid(os.stat('/proc/{}'.format(pid)).st_uid).pw_name == user)]
+def pixelize_screenshot(screenshot: BinaryIO, screenshot_pixelized: BinaryIO,
+                        target_width: int = 390, pixelsize: int = 3,
+                        image_format: str = 'png'):
+    """
+    Thumbnail a screenshot to `target_width` and pixelize it.
+
+    :param screenshot: Screenshot to be thumbnailed in pixelized
+    :param screenshot_pixelized: File to which the result should be written
+    :param target_width: Width of the final thumbnail
+    :param pixelsize: Size of the final pixels
+    :param image_format: The format of the result, i.e. png or webp
+    :return: None
+    """
+    if target_width % pixelsize != 0:
+        raise ValueError("pixelsize must divide target_width")
+
+    img = Image.open(screenshot)
+    width, height = img.size
+    if height > width:
+        img = img.crop((0, 0, width, width))
+        height = width
+    undersampling_width = target_width // pixelsize
+    ratio = width / height
+    new_height = int(undersampling_width / ratio)
+    img = img.resize((undersampling_width, new_height), Image.BICUBIC)
+    img = img.resize((target_width, new_height * pixelsize), Image.NEAREST)
+    img.save(screenshot_pixelized, format=image_format)
+
+
+def get_child_processes(pid: int) -> List[int]:
+    """Get the pids of all (transitive) child processes of pid."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry), 'r') as f:
+                stat = f.read()
+        except OSError:
+            # process has terminated in the meantime
+            continue
+        # the command name is in parentheses and may contain spaces
+        ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+
+    result = []
+    parents = [pid]
+    while parents:
+        for child in children.get(parents.pop(), []):
+            result.append(child)
+            parents.append(child)
+    return result
+
+
+def get_process_tree_memory(pid: int) -> int:
+    """Get the resident memory in bytes of pid and all of its child
+    processes."""
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    memory = 0
+    for process in [pid] + get_child_processes(pid):
+        try:
+            with open('/proc/{}/statm'.format(process), 'r') as f:
+                memory += int(f.read().split()[1]) * page_size
+        except OSError:
+            # process has terminated in the meantime
+            continue
+    return memory
+
+
+def kill_child_processes():
+    """Kill all process groups started by run_supervised and all remaining
+    child processes of the current process except for the persistent
+    processes and their children."""
+    for pgid in list(_supervised_process_groups):
+        _kill_process_group(pgid)
+    persistent = set(_persistent_processes)
+    for pid in _persistent_processes:
+        persistent.update(get_child_processes(pid))
+    for pid in get_child_processes(os.getpid()):
+        if pid in persistent:
+            continue
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            continue
+
+
+def register_persistent_process(pid: int):
+    """Keep a child process which is reused by multiple tasks, e.g. a pooled
+    browser, running when the processes of a task are killed."""
+    _persistent_processes.add(pid)
+
+
+def unregister_persistent_process(pid: int):
+    _persistent_processes.discard(pid)
+
+
+_supervised_process_groups = set()
+_persistent_processes = set()
+
+
+def _kill_process_group(pgid: int):
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def run_supervised(args: List[str], timeout: float = None,
+                   stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                   stderr=subprocess.PIPE) -> Tuple[int, bytes, bytes]:
+    """
+    Run a command in its own process group and wait for it to finish.
+
+    When the timeout expires or waiting is interrupted by an exception (i.e.
+    the timeout of a test suite), the whole process group of the command is
+    killed. Processes of other commands -- for instance those run by other
+    tasks on the same host -- are never affected. Processes remaining in the
+    process group after the command has finished are killed as well.
+
+    Returns a tuple (returncode, stdout, stderr). subprocess.TimeoutExpired is
+    raised when the timeout expires.
+    """
+    proc = subprocess.Popen(
+        args, stdin=stdin, stdout=stdout, stderr=stderr,
+        start_new_session=True)
+    # With start_new_session, the pid of the process is its process group id.
+    _supervised_process_groups.add(proc.pid)
+    try:
+        out, err = proc.communicate(timeout=timeout)
+        return proc.returncode, out, err
+    except BaseException:
+        _kill_process_group(proc.pid)
+        proc.communicate()
+        raise
+    finally:
+        _kill_process_group(proc.pid)
+        _supervised_process_groups.discard(proc.pid)
 
 
 class get_worker_id: